@@ -1,4 +1,7 @@
 
-from .util import is_port_available, docker_container_name, find_free_port, download_file, unpack_targz, pid_exists
-from .states import DBServerState, FhirServerState
+from .util import is_port_available, docker_container_name, find_free_port, download_file, unpack_targz, pid_exists, \
+    wait_until, is_postgres_ready, is_http_ready, cache_home, link_or_copy, file_sha512, \
+    host_memory_bytes, clone_file, tree_sha256, process_peak_rss, atomic_write, reap_child
+from .states import IndexedState, DBServerState, FhirServerState
+from .state_index import StateIndex
 
@@ -0,0 +1,109 @@
+import hashlib
+import os
+import shutil
+import typing as t
+from pathlib import Path
+
+from filelock import FileLock, Timeout
+
+from setupservers.tracing import traced
+from setupservers.util import cache_home, download_file, file_sha512, unpack_targz
+
+
+class DirectoryCache(object):
+    """
+    A content addressed store of directories under the user cache. Entries are written to a temporary directory and
+    renamed into place so a reader never sees a partial entry. Entries are evicted least recently used first once
+    there are more than max_entries of them.
+    """
+    COMPLETE_STAMP = '.complete'
+
+    def __init__(self, name: str, max_entries: t.Optional[int] = None):
+        self.path: Path = cache_home() / name
+        self.max_entries: t.Optional[int] = max_entries
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.sha256('\0'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+    def entry_path(self, key: str) -> Path:
+        return self.path / key
+
+    def lock(self, key: str) -> FileLock:
+        return FileLock(str(self.path / f'{key}.lock'))
+
+    def get(self, key: str) -> t.Optional[Path]:
+        stamp = self.entry_path(key) / DirectoryCache.COMPLETE_STAMP
+        if not stamp.exists():
+            return None
+        stamp.touch()
+        return self.entry_path(key)
+
+    def put(self, key: str, populate: t.Callable[[Path], None]) -> Path:
+        """Create or replace an entry. Callers should hold lock(key)."""
+        tmp_path = self.path / f'{key}.tmp-{os.getpid()}'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir()
+        try:
+            populate(tmp_path)
+            (tmp_path / DirectoryCache.COMPLETE_STAMP).touch()
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            tmp_path.rename(self.entry_path(key))
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict(keep=key)
+        return self.entry_path(key)
+
+    def evict(self, keep: t.Optional[str] = None):
+        if self.max_entries is None:
+            return
+        entries = [p for p in self.path.iterdir() if (p / DirectoryCache.COMPLETE_STAMP).exists() and p.name != keep]
+        entries.sort(key=lambda p: (p / DirectoryCache.COMPLETE_STAMP).stat().st_mtime)
+        excess = len(entries) + (1 if keep else 0) - self.max_entries
+        for entry in entries[:max(excess, 0)]:
+            try:
+                # skip entries another process is currently using
+                with self.lock(entry.name).acquire(timeout=0):
+                    shutil.rmtree(entry, ignore_errors=True)
+            except Timeout:
+                pass
+
+
+@traced('cached download')
+def cached_download(url: str, sha512_url: t.Optional[str] = None) -> Path:
+    """Download url once per machine into the user cache and return the cached file. Other callers wait on the lock
+    while a download is in progress, and a partial download is resumed by the next caller.
+    """
+    cache = DirectoryCache('downloads')
+    key = DirectoryCache.key(url)
+    file_name = url.rsplit('/', 1)[-1]
+    with cache.lock(key):
+        entry = cache.get(key)
+        if entry is None:
+            download_path = cache.path / f'{key}.download'
+            download_file(url, download_path, sha512_url)
+            entry = cache.put(key, lambda entry_path: download_path.replace(entry_path / file_name))
+    return entry / file_name
+
+
+@traced('cached unpack')
+def cached_unpack(file: Path) -> Path:
+    """Extract an archive once into the shared tool cache and return the directory it was extracted to. The files are
+    made read-only since every work dir using the tool points at the same copy.
+    """
+    cache = DirectoryCache('tools')
+    key = DirectoryCache.key(file_sha512(file))
+    with cache.lock(key):
+        entry = cache.get(key)
+        if entry is None:
+            def populate(entry_path: Path):
+                unpack_targz(file, entry_path)
+                for dir_path, _, file_names in os.walk(entry_path):
+                    for file_name in file_names:
+                        file_path = Path(dir_path) / file_name
+                        if not file_path.is_symlink():
+                            file_path.chmod(file_path.stat().st_mode & ~0o222)
+
+            entry = cache.put(key, populate)
+    return entry
@@ -0,0 +1,375 @@
+import asyncio
+import gzip
+import json
+import logging
+import random
+import time
+import typing as t
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import click
+from clickactions import Command, Actions
+
+from setupservers import FhirServerState
+from setupservers.fhir_client import FhirConnection
+from setupservers.graph import get_action_graph
+from setupservers.tracing import span
+
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+CHECKPOINT_SECONDS = 5
+INGEST_SUFFIXES = ('.ndjson', '.jsonl', '.json')
+
+
+@click.command(name='fhir-ingest', cls=Command)
+@click.argument('files', nargs=-1, required=True, type=click.Path(exists=True, path_type=Path))
+@click.option('--work-dir', help='Work dir of the HAPI to load, its fhir_url is read from the state and the progress '
+                                 'is checkpointed in it.')
+@click.option('--fhir-url', help='Load this FHIR base URL instead of a managed HAPI. Progress is not checkpointed.')
+@click.option('--bundle-type', type=click.Choice(['batch', 'transaction']), default='batch',
+              help='batch: entries succeed or fail on their own. transaction: all entries of a bundle or none.')
+@click.option('--batch-size', type=int, default=500, help='Resources per posted bundle.')
+@click.option('--concurrency', type=int, default=4, help='Bundles in flight, one keep-alive connection each.')
+@click.option('--retries', type=int, default=5, help='Retries of a bundle after a connection error, timeout, 429 or '
+                                                     '5xx response.')
+@click.option('--backoff', type=float, default=1.0, help='Seconds before the first retry, doubled for each next one.')
+@click.option('--timeout', type=float, default=300, help='Seconds for the server to answer one bundle.')
+@click.option('--restart', is_flag=True, help='Ignore the checkpoints and load the files from the start.')
+@click.pass_context
+def command(ctx: click.Context, files, work_dir, fhir_url, bundle_type, batch_size, concurrency, retries, backoff,
+            timeout, restart):
+    """
+    Stream NDJSON files (one resource per line, optionally gzipped) or Bundle JSON files into a FHIR server.
+    Directories are searched for .ndjson, .jsonl and .json files.
+    """
+    actions: Actions = ctx.obj
+    if get_action_graph(ctx) is not None:
+        raise click.UsageError('fhir-ingest can not run with --parallel.')
+
+    state: t.Optional[FhirServerState] = None
+    if work_dir:
+        state = actions.get_action_state(work_dir, FhirServerState)
+        fhir_url = fhir_url or state.fhir_url
+    if not fhir_url:
+        raise click.UsageError('Give --fhir-url, or the --work-dir of a started HAPI.')
+    if state is not None and restart:
+        state.ingest_checkpoints = {}
+        state.save()
+
+    ingest = FhirIngest(fhir_url, bundle_type, batch_size, concurrency, retries, backoff, timeout, actions.logger)
+    with span('fhir-ingest', work_dir=state.path if state is not None else None, url=fhir_url):
+        for path in ingest_files(files):
+            checkpoint = Checkpoint(state, path)
+            if checkpoint.complete:
+                actions.logger.info(f"Skipping {path}, it was loaded completely before.")
+                continue
+            if checkpoint.resources:
+                actions.logger.info(f"Resuming {path} after {checkpoint.resources} resources.")
+            with span('fhir-ingest file', file=str(path)):
+                asyncio.run(ingest.ingest(path, checkpoint))
+
+    report = ingest.report()
+    actions.logger.info(f"Loaded {report['resources']} resources in {report['seconds']:.1f}s "
+                        f"({report['resources_per_second']:.0f}/s), {report['entry_errors']} failed entries, "
+                        f"{report['retries']} retries.")
+    click.echo(json.dumps(report, indent=2))
+
+
+def ingest_files(paths: t.Iterable[Path]) -> t.List[Path]:
+    files = []
+    for path in paths:
+        if path.is_dir():
+            files.extend(sorted(p for p in path.rglob('*') if p.is_file() and _format(p) is not None))
+        else:
+            files.append(path)
+    return [file.resolve() for file in files]
+
+
+def read_entries(path: Path) -> t.Iterator[t.Dict[str, t.Any]]:
+    """Bundle entries from an NDJSON or Bundle file, one at a time without reading the whole file."""
+    opener = gzip.open if path.suffix == '.gz' else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        if _format(path) == 'ndjson':
+            for line in f:
+                if line.strip():
+                    yield {'resource': json.loads(line)}
+        else:
+            yield from _BundleReader(f).entries()
+
+
+class Checkpoint(object):
+    """How many resources of a file were loaded, saved in the FHIR server state at most every CHECKPOINT_SECONDS.
+    A file that changed since its checkpoint is loaded again from the start.
+    """
+
+    def __init__(self, state: t.Optional[FhirServerState], path: Path):
+        self.state = state
+        self.path = path
+        stat = path.stat()
+        self.stamp = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        self.resources = 0
+        self.complete = False
+        self._saved = time.monotonic()
+
+        recorded = state.ingest_checkpoints.get(str(path)) if state is not None else None
+        if recorded is not None and all(recorded.get(name) == value for name, value in self.stamp.items()):
+            self.resources = recorded['resources']
+            self.complete = recorded['complete']
+
+    def advance(self, resources: int, complete: bool = False, force: bool = False):
+        self.resources = resources
+        self.complete = complete
+        if self.state is None or not (force or complete or time.monotonic() - self._saved >= CHECKPOINT_SECONDS):
+            return
+        self.state.ingest_checkpoints[str(self.path)] = dict(self.stamp, resources=resources, complete=complete)
+        self.state.save()
+        self._saved = time.monotonic()
+
+
+class FhirIngest(object):
+    """
+    Posts bundles of batch_size entries from concurrency asyncio tasks. The file is read by one producer that stays at
+    most two bundles per task ahead of the posting. Bundles finish out of order, the checkpoint only moves past a
+    bundle once every bundle before it finished, so a resumed load never skips resources. Entries without a request
+    are PUT by id when they have one, which makes posting a bundle again after a retry or resume harmless.
+    """
+
+    def __init__(self, fhir_url: str, bundle_type: str, batch_size: int, concurrency: int, retries: int,
+                 backoff: float, timeout: float, logger: logging.Logger):
+        self.base = urlsplit(fhir_url.rstrip('/'))
+        self.bundle_type = bundle_type
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.logger = logger
+
+        self.resources = 0
+        self.bundles = 0
+        self.retried = 0
+        self.entry_errors = 0
+        self.seconds = 0.0
+        self._failure: t.Optional[BaseException] = None
+
+    async def ingest(self, path: Path, checkpoint: Checkpoint):
+        self._failure = None
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        finished: t.Dict[int, int] = {}
+        progress = {'next': 0, 'resources': checkpoint.resources}
+
+        def bundle_done(index: int, size: int):
+            finished[index] = size
+            while progress['next'] in finished:
+                progress['resources'] += finished.pop(progress['next'])
+                progress['next'] += 1
+            checkpoint.advance(progress['resources'])
+
+        start = time.monotonic()
+        workers = [asyncio.ensure_future(self._worker(queue, bundle_done)) for _ in range(self.concurrency)]
+        posted_all = False
+        try:
+            index = 0
+            entries = []
+            for position, entry in enumerate(read_entries(path)):
+                if position < checkpoint.resources:
+                    continue
+                entries.append(_with_request(entry))
+                if len(entries) == self.batch_size:
+                    await self._put(queue, index, entries)
+                    index += 1
+                    entries = []
+                if self._failure is not None:
+                    break
+            if entries and self._failure is None:
+                await self._put(queue, index, entries)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+            posted_all = self._failure is None
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.seconds += time.monotonic() - start
+            checkpoint.advance(progress['resources'], complete=posted_all, force=True)
+        if self._failure is not None:
+            raise self._failure
+
+    async def _put(self, queue: asyncio.Queue, index: int, entries: t.List[t.Dict[str, t.Any]]):
+        bundle = {'resourceType': 'Bundle', 'type': self.bundle_type, 'entry': entries}
+        await queue.put((index, len(entries), json.dumps(bundle).encode('utf-8')))
+
+    async def _worker(self, queue: asyncio.Queue, bundle_done: t.Callable[[int, int], None]):
+        connection = FhirConnection(self.base, self.timeout)
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                if self._failure is not None:
+                    # drain so the producer is not blocked
+                    continue
+                index, size, body = item
+                try:
+                    content = await self._post(connection, body)
+                except Exception as e:
+                    self._failure = e
+                    continue
+                self._count_entry_errors(content)
+                self.resources += size
+                self.bundles += 1
+                bundle_done(index, size)
+        finally:
+            connection.close()
+
+    async def _post(self, connection: FhirConnection, body: bytes) -> bytes:
+        attempt = 0
+        while True:
+            try:
+                status, headers, content = await connection.request('POST', '', body)
+                if status < 300:
+                    return content
+                if status not in RETRY_STATUSES:
+                    raise Exception(f'{self.bundle_type} bundle rejected with {status}: {content[:1000]!r}')
+                problem = f'status {status}'
+                retry_after = headers.get('retry-after', '')
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                problem = f'{type(e).__name__}: {e}'
+                retry_after = ''
+            if attempt >= self.retries:
+                raise Exception(f'{self.bundle_type} bundle failed after {attempt} retries, last with {problem}')
+            delay = float(retry_after) if retry_after.isdigit() else \
+                self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            self.logger.warning(f"Posting a bundle failed with {problem}, retrying in {delay:.1f}s")
+            attempt += 1
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+    def _count_entry_errors(self, content: bytes):
+        try:
+            entries = json.loads(content).get('entry', [])
+        except (ValueError, AttributeError):
+            return
+        for entry in entries:
+            status = entry.get('response', {}).get('status', '')
+            if status and not status.startswith('2'):
+                self.entry_errors += 1
+                if self.entry_errors <= 10:
+                    outcome = entry['response'].get('outcome', {})
+                    issues = [issue['diagnostics'] for issue in outcome.get('issue', []) if issue.get('diagnostics')]
+                    self.logger.warning(f"Entry failed with {status}" + (f": {'; '.join(issues)}" if issues else ''))
+
+    def report(self) -> t.Dict[str, t.Any]:
+        return {
+            'fhir_url': self.base.geturl(),
+            'bundle_type': self.bundle_type,
+            'batch_size': self.batch_size,
+            'concurrency': self.concurrency,
+            'resources': self.resources,
+            'bundles': self.bundles,
+            'entry_errors': self.entry_errors,
+            'retries': self.retried,
+            'seconds': self.seconds,
+            'resources_per_second': self.resources / self.seconds if self.seconds else 0,
+        }
+
+
+class _BundleReader(object):
+    """Reads the entries of a Bundle from a text file one at a time, keeping about one chunk in memory."""
+
+    def __init__(self, f: t.TextIO, chunk_size: int = 1024 * 1024):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def entries(self) -> t.Iterator[t.Dict[str, t.Any]]:
+        if not self._find_entry_array():
+            return
+        while True:
+            char = self._next_significant(skip=' \t\r\n,')
+            if char is None:
+                raise ValueError(f'{self.f.name} ends inside the entry array.')
+            if char == ']':
+                return
+            try:
+                entry, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # an entry can't decode before its closing brace, read on unless there is nothing left
+                if self.eof:
+                    raise
+                self._read()
+                continue
+            self.pos = end
+            yield entry
+
+    def _find_entry_array(self) -> bool:
+        """Move to the first element of the top level "entry" array."""
+        depth = 0
+        while True:
+            char = self._next_significant(skip=' \t\r\n,:')
+            if char is None:
+                return False
+            if char in '{[':
+                depth += 1
+                self.pos += 1
+            elif char in '}]':
+                depth -= 1
+                self.pos += 1
+            elif char == '"':
+                key = self._string()
+                if depth == 1 and key == 'entry' and self._next_significant(skip=' \t\r\n:') == '[':
+                    self.pos += 1
+                    return True
+            else:
+                # numbers, true, false, null
+                self.pos += 1
+
+    def _string(self) -> str:
+        while True:
+            try:
+                value, end = json.decoder.scanstring(self.buffer, self.pos + 1)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self._read()
+                continue
+            self.pos = end
+            return value
+
+    def _next_significant(self, skip: str) -> t.Optional[str]:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in skip:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return None
+            self._read()
+
+    def _read(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+
+def _format(path: Path) -> t.Optional[str]:
+    suffixes = [suffix for suffix in path.suffixes if suffix != '.gz']
+    if not suffixes or suffixes[-1] not in INGEST_SUFFIXES:
+        return None
+    return 'bundle' if suffixes[-1] == '.json' else 'ndjson'
+
+
+def _with_request(entry: t.Dict[str, t.Any]) -> t.Dict[str, t.Any]:
+    if 'request' in entry:
+        return entry
+    resource = entry['resource']
+    if resource.get('id'):
+        request = {'method': 'PUT', 'url': f"{resource['resourceType']}/{resource['id']}"}
+    else:
+        request = {'method': 'POST', 'url': resource['resourceType']}
+    return dict(entry, request=request)
@@ -0,0 +1,243 @@
+import asyncio
+import json
+import math
+import random
+import time
+import typing as t
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import click
+from clickactions import Command, Actions
+
+from setupservers import FhirServerState
+from setupservers.fhir_client import FhirConnection
+from setupservers.graph import get_action_graph
+from setupservers.tracing import span
+
+OPERATIONS = ['create', 'read', 'search']
+
+DEFAULT_RESOURCE = {
+    'resourceType': 'Patient',
+    'name': [{'family': 'Load', 'given': ['Test']}],
+    'gender': 'unknown',
+    'birthDate': '1970-01-01',
+}
+
+
+@click.command(name='fhir-load', cls=Command)
+@click.option('--work-dir', help='Work dir of the HAPI to load, its fhir_url is read from the state.')
+@click.option('--fhir-url', help='Load this FHIR base URL instead of a managed HAPI.')
+@click.option('--mix', default='read=70,search=20,create=10',
+              help='Relative weights of the create, read and search requests.')
+@click.option('--concurrency', type=int, default=8, help='Requests in flight, one keep-alive connection each.')
+@click.option('--rate', type=float, default=0, help='Requests per second over all connections. 0 for as fast as '
+                                                    'the server answers.')
+@click.option('--duration', type=float, default=30, help='Seconds to run.')
+@click.option('--requests', 'max_requests', type=int, help='Stop after this many requests.')
+@click.option('--seed-resources', type=int, default=20, help='Resources created before the run for the reads to use.')
+@click.option('--resource-file', help='JSON resource to create. Defaults to a small Patient.')
+@click.option('--search', 'search_query', help='Search query. Defaults to _count=10 on the created resource type.')
+@click.option('--timeout', type=float, default=30, help='Seconds before a request counts as failed.')
+@click.option('--random-seed', type=int, help='Makes the request sequence repeatable.')
+@click.option('--results', help='JSON report file. Defaults to <work-dir>/fhir-load.json.')
+@click.pass_context
+def command(ctx: click.Context, work_dir, fhir_url, mix, concurrency, rate, duration, max_requests, seed_resources,
+            resource_file, search_query, timeout, random_seed, results):
+    actions: Actions = ctx.obj
+    if get_action_graph(ctx) is not None:
+        raise click.UsageError('fhir-load measures the servers it loads and can not run with --parallel.')
+
+    state: t.Optional[FhirServerState] = None
+    if work_dir:
+        state = actions.get_action_state(work_dir, FhirServerState)
+        fhir_url = fhir_url or state.fhir_url
+    if not fhir_url:
+        raise click.UsageError('Give --fhir-url, or the --work-dir of a started HAPI.')
+
+    resource = DEFAULT_RESOURCE
+    if resource_file:
+        with open(resource_file) as f:
+            resource = json.load(f)
+
+    load = FhirLoad(fhir_url, parse_mix(mix), resource, search_query=search_query, concurrency=concurrency,
+                    rate=rate, duration=duration, max_requests=max_requests, seed_resources=seed_resources,
+                    timeout=timeout, random_seed=random_seed)
+    with span('fhir-load', work_dir=state.path if state is not None else None, url=fhir_url):
+        report = asyncio.run(load.run())
+
+    results_path = Path(results) if results else state.path / 'fhir-load.json' if state is not None else None
+    if results_path is not None:
+        results_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(results_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        actions.logger.info(f"FHIR load report written to {results_path}")
+    click.echo(json.dumps(report, indent=2))
+
+
+def parse_mix(mix: str) -> t.Dict[str, float]:
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise click.BadParameter(f'Unknown operation {name}, expected one of {", ".join(OPERATIONS)}.',
+                                     param_hint='--mix')
+        try:
+            weights[name] = float(weight)
+        except ValueError:
+            raise click.BadParameter(f'{part} is not operation=weight.', param_hint='--mix')
+    if not any(weight > 0 for weight in weights.values()):
+        raise click.BadParameter('No operation has a positive weight.', param_hint='--mix')
+    return weights
+
+
+class FhirLoad(object):
+    """
+    Drives a weighted mix of create, read and search requests at a FHIR server from asyncio tasks, one keep-alive
+    connection per task. With a rate the requests are sent on a fixed schedule and latency is measured from each
+    request's scheduled time, so a server falling behind shows up in the latencies instead of lowering the rate.
+    """
+
+    def __init__(self, fhir_url: str, mix: t.Dict[str, float], resource: t.Dict[str, t.Any],
+                 search_query: t.Optional[str] = None, concurrency: int = 8, rate: float = 0, duration: float = 30,
+                 max_requests: t.Optional[int] = None, seed_resources: int = 20, timeout: float = 30,
+                 random_seed: t.Optional[int] = None):
+        self.base = urlsplit(fhir_url.rstrip('/'))
+        self.mix = mix
+        self.resource = resource
+        self.resource_type: str = resource['resourceType']
+        self.search_query = search_query or '_count=10'
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.max_requests = max_requests
+        self.seed_resources = seed_resources
+        self.timeout = timeout
+        self.random = random.Random(random_seed)
+
+        self.ids: t.List[str] = []
+        self.samples: t.Dict[str, t.List[float]] = {name: [] for name in OPERATIONS}
+        self.errors: t.Dict[str, int] = {name: 0 for name in OPERATIONS}
+        self.status_codes: t.Dict[str, int] = {}
+        self.error_messages: t.Dict[str, int] = {}
+        self._sent = 0
+
+    async def run(self) -> t.Dict[str, t.Any]:
+        connection = FhirConnection(self.base, self.timeout)
+        try:
+            for _ in range(self.seed_resources):
+                await self._request(connection, 'create', record=False)
+        finally:
+            connection.close()
+        if self.mix.get('read') and not self.ids:
+            raise Exception(f'No {self.resource_type} could be created for the reads to use.')
+
+        start = time.monotonic()
+        deadline = start + self.duration
+        await asyncio.gather(*(self._worker(start, deadline) for _ in range(self.concurrency)))
+        return self._report(time.monotonic() - start)
+
+    async def _worker(self, start: float, deadline: float):
+        connection = FhirConnection(self.base, self.timeout)
+        operations, weights = zip(*self.mix.items())
+        try:
+            while True:
+                if self.max_requests is not None and self._sent >= self.max_requests:
+                    return
+                # claiming the slot and its send time happens without awaiting, the tasks share one event loop
+                slot = self._sent
+                self._sent += 1
+                scheduled = start + slot / self.rate if self.rate else time.monotonic()
+                if scheduled >= deadline or time.monotonic() >= deadline:
+                    return
+                delay = scheduled - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                operation = self.random.choices(operations, weights)[0]
+                await self._request(connection, operation, scheduled=scheduled)
+        finally:
+            connection.close()
+
+    async def _request(self, connection: FhirConnection, operation: str, scheduled: t.Optional[float] = None,
+                       record: bool = True):
+        if operation == 'create':
+            method, path, body = 'POST', self.resource_type, json.dumps(self.resource).encode('utf-8')
+        elif operation == 'read':
+            method, path, body = 'GET', f'{self.resource_type}/{self.random.choice(self.ids)}', None
+        else:
+            method, path, body = 'GET', f'{self.resource_type}?{self.search_query}', None
+
+        started = scheduled if scheduled is not None else time.monotonic()
+        try:
+            status, headers, content = await connection.request(method, path, body)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+            status, headers, content = None, {}, b''
+            message = f'{type(e).__name__}: {e}'
+            self.error_messages[message] = self.error_messages.get(message, 0) + 1
+        elapsed = time.monotonic() - started
+
+        if status is not None and operation == 'create' and 200 <= status < 300:
+            resource_id = _created_id(headers, content)
+            if resource_id is not None:
+                self.ids.append(resource_id)
+        if not record:
+            return
+        self.status_codes[str(status)] = self.status_codes.get(str(status), 0) + 1
+        if status is None or status >= 400:
+            self.errors[operation] += 1
+        else:
+            self.samples[operation].append(elapsed)
+
+    def _report(self, elapsed: float) -> t.Dict[str, t.Any]:
+        operations = {}
+        for name in OPERATIONS:
+            latencies = sorted(self.samples[name])
+            count = len(latencies) + self.errors[name]
+            if not count:
+                continue
+            operations[name] = dict(requests=count, errors=self.errors[name],
+                                    error_rate=self.errors[name] / count,
+                                    throughput=count / elapsed, **_latency_summary(latencies))
+
+        latencies = sorted(value for samples in self.samples.values() for value in samples)
+        errors = sum(self.errors.values())
+        total = len(latencies) + errors
+        return {
+            'fhir_url': self.base.geturl(),
+            'concurrency': self.concurrency,
+            'rate': self.rate or None,
+            'mix': self.mix,
+            'seconds': elapsed,
+            'requests': total,
+            'errors': errors,
+            'error_rate': errors / total if total else 0,
+            'throughput': total / elapsed if elapsed else 0,
+            **_latency_summary(latencies),
+            'operations': operations,
+            'status_codes': self.status_codes,
+            'error_messages': self.error_messages,
+        }
+
+
+def _created_id(headers: t.Dict[str, str], content: bytes) -> t.Optional[str]:
+    # Location: <base>/<type>/<id>/_history/<version>
+    parts = headers.get('location', '').split('/')
+    if '_history' in parts and parts.index('_history') > 0:
+        return parts[parts.index('_history') - 1]
+    try:
+        return json.loads(content).get('id')
+    except (ValueError, AttributeError):
+        return None
+
+
+def _latency_summary(sorted_latencies: t.List[float]) -> t.Dict[str, t.Optional[float]]:
+    def percentile(q: float) -> t.Optional[float]:
+        if not sorted_latencies:
+            return None
+        # nearest rank
+        rank = max(1, math.ceil(q / 100 * len(sorted_latencies)))
+        return sorted_latencies[rank - 1] * 1000
+
+    return {'p50_ms': percentile(50), 'p95_ms': percentile(95), 'p99_ms': percentile(99),
+            'max_ms': sorted_latencies[-1] * 1000 if sorted_latencies else None}
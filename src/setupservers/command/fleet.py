@@ -0,0 +1,101 @@
+import json
+import typing as t
+from pathlib import Path
+
+import click
+from clickactions import Command, Actions
+
+from setupservers.command import postgres_docker, hapi_jpa_starter
+from setupservers.graph import ActionGraph, ACTION_GRAPH_KEY, get_action_graph
+
+FLEET_ACTIONS = {
+    'start': (['dbs-start'], ['hapi-start']),
+    'stop': (['dbs-stop'], ['hapi-stop']),
+    'remove': (['docker-remove'], ['hapi-stop']),
+}
+
+
+@click.command(name='fleet', cls=Command)
+@click.option('--work-dir', default='fleet', help='Replica i uses <work-dir>/<i>/postgres and <work-dir>/<i>/hapi.')
+@click.option('--replicas', type=int, required=True)
+@click.option('--workers', type=int, default=8,
+              help='How many steps run at the same time. Ignored when the chain runs with --parallel.')
+@click.option('--with-hapi/--without-hapi', default=True)
+@click.option('--docker-tag', default='latest')
+@click.option('--dbs-port', type=int, default=5432)
+@click.option('--git-ref', default='master')
+@click.option('--hapi-port', type=int, default=8888)
+@click.option('--spring-profiles', default='local')
+@click.option('--manifest', help='Where to write the JSON manifest. Defaults to <work-dir>/fleet.json.')
+@click.option('--action', type=click.Choice(list(FLEET_ACTIONS)), multiple=True, help='start, stop, remove')
+@click.pass_context
+def command(ctx: click.Context, work_dir, replicas, workers, with_hapi, docker_tag, dbs_port, git_ref, hapi_port,
+            spring_profiles, manifest, action):
+    actions: Actions = ctx.obj
+
+    # schedule into the chain's graph when running with --parallel, otherwise into our own
+    graph = get_action_graph(ctx)
+    run_now = graph is None
+    if run_now:
+        graph = ActionGraph(workers)
+        ctx.meta[ACTION_GRAPH_KEY] = graph
+
+    replica_dirs: t.List[t.Tuple[str, t.Optional[str]]] = [
+        (f'{work_dir}/{i}/postgres', f'{work_dir}/{i}/hapi' if with_hapi else None) for i in range(replicas)]
+    try:
+        for fleet_action in action:
+            dbs_actions, hapi_actions = FLEET_ACTIONS[fleet_action]
+            for dbs_work_dir, hapi_work_dir in replica_dirs:
+                steps = [(postgres_docker.command, dict(work_dir=dbs_work_dir, docker_tag=docker_tag,
+                                                        dbs_port=dbs_port, action=dbs_actions))]
+                if hapi_work_dir is not None:
+                    steps.append((hapi_jpa_starter.command, dict(work_dir=hapi_work_dir, git_ref=git_ref,
+                                                                 hapi_port=hapi_port, dbs_work_dir=dbs_work_dir,
+                                                                 spring_profiles=spring_profiles,
+                                                                 action=hapi_actions)))
+                # HAPI is started after its database and stopped before it
+                if fleet_action != 'start':
+                    steps.reverse()
+                for step_command, kwargs in steps:
+                    ctx.invoke(step_command, **kwargs)
+
+        manifest_path = Path(manifest) if manifest else Path(work_dir) / 'fleet.json'
+        if not manifest_path.is_absolute():
+            manifest_path = actions.actions_home_path / manifest_path
+        all_dirs = [actions.actions_home_path / d for dirs in replica_dirs for d in dirs if d is not None]
+        graph.add(f'fleet {work_dir} manifest', lambda: _write_manifest(actions, replica_dirs, manifest_path),
+                  [p.resolve() for p in all_dirs])
+    finally:
+        if run_now:
+            del ctx.meta[ACTION_GRAPH_KEY]
+
+    if run_now:
+        graph.run(actions.logger)
+
+
+def _write_manifest(actions: Actions, replica_dirs: t.List[t.Tuple[str, t.Optional[str]]], manifest_path: Path):
+    replicas = []
+    for i, (dbs_work_dir, hapi_work_dir) in enumerate(replica_dirs):
+        dbs_state = actions.get_action_state(dbs_work_dir, postgres_docker.PostgresDockerState)
+        replica = {
+            'index': i,
+            'dbs_work_dir': str(dbs_state.path),
+            'dbs_host': dbs_state.dbs_host,
+            'dbs_port': dbs_state.dbs_port,
+            'dbs_status': dbs_state.dbs_status,
+            'container_uuid': dbs_state.container_uuid,
+        }
+        if hapi_work_dir is not None:
+            hapi_state = actions.get_action_state(hapi_work_dir, hapi_jpa_starter.HapiJpaStarterState)
+            replica.update({
+                'hapi_work_dir': str(hapi_state.path),
+                'fhir_url': hapi_state.fhir_url,
+                'pid': hapi_state.pid,
+                'status': hapi_state.status,
+            })
+        replicas.append(replica)
+
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        json.dump({'replicas': replicas}, f, indent=2)
+    actions.logger.info(f"Fleet manifest written to {manifest_path}")
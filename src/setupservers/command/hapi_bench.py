@@ -0,0 +1,170 @@
+import json
+import re
+import shutil
+import statistics
+import time
+import typing as t
+from pathlib import Path
+
+import click
+from clickactions import Command, Actions
+
+import setupservers
+from setupservers import tracing
+from setupservers.command import postgres_docker, hapi_jpa_starter
+from setupservers.graph import get_action_graph
+
+METRICS = ['dbs_start_seconds', 'hapi_prepare_seconds', 'jvm_ready_seconds', 'first_request_seconds',
+           'time_to_first_request_seconds', 'peak_rss_mb']
+# a search goes through the JPA layer and the database, unlike /metadata which the readiness probe uses
+FIRST_REQUEST = 'Patient?_count=1'
+
+
+@click.command(name='hapi-bench', cls=Command)
+@click.option('--work-dir', default='hapi-bench')
+@click.option('--git-ref', multiple=True, help='Refs to compare. Defaults to master.')
+@click.option('--dbs', type=click.Choice(['none', 'postgres']), multiple=True,
+              help='Run without a database (HAPI\'s embedded H2) and/or with a linked postgres-docker. Defaults to both.')
+@click.option('--spring-profiles', default='local')
+@click.option('--dbs-profile', type=click.Choice(['durable', 'ephemeral', 'throughput']), default='ephemeral')
+@click.option('--jvm-profile', type=click.Choice(list(hapi_jpa_starter.JVM_PROFILES)), default='default')
+@click.option('--cold-runs', type=int, default=1, help='Starts with a new database, or a new H2 database without one.')
+@click.option('--warm-runs', type=int, default=3, help='HAPI restarts against the database of the last start.')
+@click.option('--results', help='JSON results file. Defaults to <work-dir>/results.json.')
+@click.option('--baseline', help='JSON results to compare against. Defaults to <work-dir>/baseline.json.')
+@click.option('--save-baseline', is_flag=True, help='Also store these results as the baseline.')
+@click.pass_context
+def command(ctx: click.Context, work_dir, git_ref, dbs, spring_profiles, dbs_profile, jvm_profile, cold_runs,
+            warm_runs, results, baseline, save_baseline):
+    actions: Actions = ctx.obj
+    if get_action_graph(ctx) is not None:
+        raise click.UsageError('hapi-bench times its steps one after the other and can not run with --parallel.')
+    bench_path = actions.actions_home_path / work_dir
+    results_path = Path(results) if results else bench_path / 'results.json'
+    baseline_path = Path(baseline) if baseline else bench_path / 'baseline.json'
+
+    runs = []
+    for ref in git_ref or ['master']:
+        for db in dbs or ['none', 'postgres']:
+            config = f'{ref}/{db}'
+            config_dir = f"{work_dir}/{re.sub('[^a-zA-Z0-9_.-]', '_', ref)}-{db}"
+            bench = _ConfigBench(ctx, config_dir, ref, db, spring_profiles, dbs_profile, jvm_profile)
+            try:
+                for i in range(cold_runs):
+                    runs.append(bench.run(dict(config=config, kind='cold', run=i), cold=True))
+                for i in range(warm_runs):
+                    runs.append(bench.run(dict(config=config, kind='warm', run=i), cold=False))
+            finally:
+                bench.stop(remove=True)
+
+    summary = _summarize(runs)
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(results_path, 'w') as f:
+        json.dump({'runs': runs, 'summary': summary}, f, indent=2)
+    actions.logger.info(f"HAPI bench results written to {results_path}")
+
+    baseline_summary = {}
+    if baseline_path.exists():
+        with open(baseline_path) as f:
+            baseline_summary = json.load(f).get('summary', {})
+    click.echo(_comparison_table(summary, baseline_summary))
+
+    if save_baseline:
+        shutil.copy(results_path, baseline_path)
+        actions.logger.info(f"HAPI bench baseline saved to {baseline_path}")
+
+
+class _ConfigBench(object):
+    def __init__(self, ctx: click.Context, config_dir: str, git_ref: str, db: str, spring_profiles: str,
+                 dbs_profile: str, jvm_profile: str):
+        self.ctx = ctx
+        self.actions: Actions = ctx.obj
+        self.hapi_work_dir = f'{config_dir}/hapi'
+        self.dbs_work_dir = f'{config_dir}/postgres' if db == 'postgres' else None
+        self.hapi_kwargs = dict(work_dir=self.hapi_work_dir, git_ref=git_ref, dbs_work_dir=self.dbs_work_dir,
+                                spring_profiles=spring_profiles, jvm_profile=jvm_profile)
+        self.dbs_profile = dbs_profile
+        self.last_run: t.Optional[t.Dict[str, t.Any]] = None
+
+    def run(self, measurements: t.Dict[str, t.Any], cold: bool) -> t.Dict[str, t.Any]:
+        """Start the configuration and add the timings to measurements. The peak RSS is updated until the next
+        run or stop."""
+        self.stop(remove=cold)
+        self.last_run = measurements
+
+        if self.dbs_work_dir is not None:
+            start = time.monotonic()
+            self.ctx.invoke(postgres_docker.command, work_dir=self.dbs_work_dir, dbs_profile=self.dbs_profile,
+                            action=['dbs-start'])
+            measurements['dbs_start_seconds'] = time.monotonic() - start
+
+        spans_before = len(tracing.completed_spans)
+        start = time.monotonic()
+        self.ctx.invoke(hapi_jpa_starter.command, action=['hapi-start'], **self.hapi_kwargs)
+        hapi_state = self.actions.get_action_state(self.hapi_work_dir, hapi_jpa_starter.HapiJpaStarterState)
+        measurements['jvm_ready_seconds'] = hapi_state.fhir_ready_seconds
+        prepare = [record['wall_seconds'] for record in tracing.completed_spans[spans_before:]
+                   if record['name'] == 'hapi-jpa-starter prepare']
+        measurements['hapi_prepare_seconds'] = sum(prepare) if prepare else None
+
+        import requests
+        request_start = time.monotonic()
+        requests.get(f'{hapi_state.fhir_url}/{FIRST_REQUEST}', timeout=120).raise_for_status()
+        end = time.monotonic()
+        measurements['first_request_seconds'] = end - request_start
+        measurements['time_to_first_request_seconds'] = end - start
+        measurements['git_sha'] = hapi_state.git_sha
+        self._sample_peak_rss()
+        return measurements
+
+    def stop(self, remove: bool):
+        # VmHWM is the high water mark over the JVM's life, read it as late as possible
+        self._sample_peak_rss()
+        self.last_run = None
+        self.ctx.invoke(hapi_jpa_starter.command, action=['hapi-stop'], **self.hapi_kwargs)
+        if not remove:
+            return
+        if self.dbs_work_dir is None:
+            hapi_state = self.actions.get_action_state(self.hapi_work_dir, hapi_jpa_starter.HapiJpaStarterState)
+            shutil.rmtree(hapi_state.path / hapi_jpa_starter.HAPI_RUN_DIR / hapi_jpa_starter.HAPI_H2_DIR,
+                          ignore_errors=True)
+            return
+        self.ctx.invoke(postgres_docker.command, work_dir=self.dbs_work_dir, action=['docker-remove'])
+        dbs_state = self.actions.get_action_state(self.dbs_work_dir, postgres_docker.PostgresDockerState)
+        # a cold start also means a new database
+        shutil.rmtree(dbs_state.path / 'docker-volume', ignore_errors=True)
+
+    def _sample_peak_rss(self):
+        if self.last_run is None:
+            return
+        hapi_state = self.actions.get_action_state(self.hapi_work_dir, hapi_jpa_starter.HapiJpaStarterState)
+        peak_rss = setupservers.process_peak_rss(hapi_state.pid) if hapi_state.pid else None
+        if peak_rss is not None:
+            self.last_run['peak_rss_mb'] = max(peak_rss / 1024 ** 2, self.last_run.get('peak_rss_mb') or 0)
+
+
+def _summarize(runs: t.List[t.Dict[str, t.Any]]) -> t.Dict[str, t.Dict[str, t.Dict[str, float]]]:
+    """Median of each metric per configuration and kind of start."""
+    summary: t.Dict[str, t.Dict[str, t.Dict[str, float]]] = {}
+    for run in runs:
+        summary.setdefault(run['config'], {}).setdefault(run['kind'], {})
+    for config, kinds in summary.items():
+        for kind, medians in kinds.items():
+            for metric in METRICS:
+                values = [run[metric] for run in runs if run['config'] == config and run['kind'] == kind
+                          and run.get(metric) is not None]
+                if values:
+                    medians[metric] = statistics.median(values)
+    return summary
+
+
+def _comparison_table(summary, baseline) -> str:
+    rows = [('config', 'start', 'metric', 'median', 'baseline', 'change')]
+    for config, kinds in summary.items():
+        for kind, medians in kinds.items():
+            for metric, value in medians.items():
+                base = baseline.get(config, {}).get(kind, {}).get(metric)
+                change = f'{(value - base) / base * 100:+.1f}%' if base else ''
+                rows.append((config, kind, metric, f'{value:.2f}', f'{base:.2f}' if base is not None else '', change))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows)
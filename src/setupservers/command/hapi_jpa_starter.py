@@ -1,34 +1,53 @@
 import errno
+import logging
 import os
 import pathlib
 import platform
+import re
 import shutil
 import signal
 import subprocess
+import sys
 import time
 import typing as t
+import zipfile
 from pathlib import Path
-from subprocess import CompletedProcess
-from typing import Union, Any
 
 import click
-import git
 import yaml
 from clickactions import Command, Action, Actions
-from git import Repo
 
 import setupservers
 from setupservers import FhirServerState
+from setupservers.cache import DirectoryCache, cached_download, cached_unpack
+from setupservers.graph import ActionGraph, get_action_graph
+from setupservers.hapi_output import read_report
+from setupservers.ports import PortRegistry
+from setupservers.state_index import StateIndex
+from setupservers.process_output import OutputLog
+from setupservers.tracing import traced, span
 
 
 class HapiJpaStarterParams(object):
     def __init__(self):
         self.git_url: t.Optional[str] = None
         self.git_ref: t.Optional[str] = None
+        self.git_mirror: t.Optional[bool] = True
         self.hapi_port: t.Optional[int] = None
         self.mvn_local_repo: t.Optional[str] = None
         self.mvn_rebuild: t.Optional[bool] = False
+        self.mvn_strategy: t.Optional[str] = None
+        self.mvn_threads: t.Optional[str] = None
+        self.mvn_skip_tests: t.Optional[bool] = False
+        self.mvnd: t.Optional[bool] = False
         self.dbs_work_dir: t.Optional[str] = None
+        self.dbs_database: t.Optional[str] = None
+        self.dbs_pooler: t.Optional[bool] = True
+        self.jdbc_pool_size: t.Optional[int] = None
+        self.jdbc_min_idle: t.Optional[int] = None
+        self.jdbc_connection_timeout: t.Optional[int] = None
+        self.jdbc_max_lifetime: t.Optional[int] = None
+        self.jdbc_statement_cache: t.Optional[int] = None
         self.actions: t.Optional[t.List[str]] = []
 
         self.java_debug: t.Optional[bool] = False
@@ -38,6 +57,15 @@ class HapiJpaStarterParams(object):
         self.java_debug_port: t.Optional[int] = None
 
         self.spring_profiles: t.Optional[str] = None
+        self.build_cache: t.Optional[bool] = True
+        self.build_cache_size: t.Optional[int] = None
+        self.ready_timeout: t.Optional[int] = None
+
+        self.jvm_profile: t.Optional[str] = None
+        self.jvm_heap: t.Optional[str] = None
+        self.jvm_opts: t.Optional[t.List[str]] = []
+        self.app_cds: t.Optional[bool] = False
+        self.exploded_war: t.Optional[bool] = False
 
 
 class HapiJpaStarterState(FhirServerState):
@@ -47,16 +75,47 @@ class HapiJpaStarterState(FhirServerState):
 
         if not hasattr(self, 'git_sha'):
             self.git_sha: t.Optional[str] = None
+        if not hasattr(self, 'jvm_args'):
+            self.jvm_args: t.List[str] = []
+        if not hasattr(self, 'dbs_work_dir'):
+            self.dbs_work_dir: t.Optional[str] = None
+        if not hasattr(self, 'dbs_database'):
+            self.dbs_database: t.Optional[str] = None
 
 
 @click.command(name='hapi-jpa-starter', cls=Command)
 @click.option('--work-dir', help='The work directory for this run of the command.')
 @click.option('--git-url', default='https://github.com/hapifhir/hapi-fhir-jpaserver-starter.git')
 @click.option('--git-ref', default='master')
+@click.option('--git-mirror/--no-git-mirror', default=True,
+              help='Check out as a worktree of a bare mirror shared by all work dirs, and skip fetching when --git-ref '
+                   'is a sha that is already present.')
 @click.option('--hapi-port', type=int, default=8888)
 @click.option('--mvn-local-repo', default='.m2')
-@click.option('--mvn-rebuild', is_flag=True)
+@click.option('--mvn-rebuild', is_flag=True,
+              help='Build the checkout as it is, e.g. with local changes. The build is not shared through the '
+                   'build cache.')
+@click.option('--mvn-strategy', type=click.Choice(['clean', 'incremental', 'offline']), default='clean',
+              help='clean: -U clean package. incremental: package without clean or update checks. offline: '
+                   'incremental with -o once the local Maven repository is populated.')
+@click.option('--mvn-threads', help='Parallel module builds, passed to Maven as -T (e.g. 4 or 1C).')
+@click.option('--mvn-skip-tests', is_flag=True)
+@click.option('--mvnd', is_flag=True, help='Build with the Maven daemon (mvnd) when it is on the PATH.')
+@click.option('--build-cache/--no-build-cache', default=True,
+              help='Share built HAPI WARs between work dirs through the user cache, keyed on the git sha and build '
+                   'settings.')
+@click.option('--build-cache-size', type=int, default=10, help='Maximum number of builds kept in the cache.')
 @click.option('--dbs-work-dir')
+@click.option('--dbs-database', help='A database created with postgres-docker --action db-create in the --dbs-work-dir '
+                                     'server, used with the role owning it. Defaults to the postgres database.')
+@click.option('--dbs-pooler/--no-dbs-pooler', default=True,
+              help='Connect through the connection pooler of the --dbs-work-dir server when it runs one.')
+@click.option('--jdbc-pool-size', type=int, help='HikariCP maximum-pool-size.')
+@click.option('--jdbc-min-idle', type=int, help='HikariCP minimum-idle.')
+@click.option('--jdbc-connection-timeout', type=int, help='HikariCP connection-timeout, in milliseconds.')
+@click.option('--jdbc-max-lifetime', type=int, help='HikariCP max-lifetime, in milliseconds.')
+@click.option('--jdbc-statement-cache', type=int,
+              help='Prepared statements the PostgreSQL driver caches per connection (preparedStatementCacheQueries).')
 @click.option('--spring-profiles', default='local')
 @click.option('--action', multiple=True, help='hapi-start  hapi-stop')
 @click.option('--java-debug', is_flag=True)
@@ -64,16 +123,42 @@ class HapiJpaStarterState(FhirServerState):
 @click.option('--java-debug-suspend', is_flag=True)
 @click.option('--java-debug-ip', default='127.0.0.1')
 @click.option('--java-debug-port', type=int, default=8999)
+@click.option('--jvm-profile', type=click.Choice(['default', 'fast-start', 'throughput']), default='default',
+              help='JVM flag presets. fast-start: C1 only, serial GC. throughput: G1 with string deduplication.')
+@click.option('--jvm-heap', help='Maximum heap, e.g. 2g.')
+@click.option('--jvm-opt', multiple=True, help='Extra JVM option, added after the profile flags.')
+@click.option('--app-cds', is_flag=True,
+              help='Record an AppCDS archive for the current git sha on the first run (written when HAPI stops) and '
+                   'start from it afterwards. Requires JDK 13+.')
+@click.option('--exploded-war', is_flag=True,
+              help='Run from an extracted ROOT.war on a flat classpath instead of java -jar. Lets AppCDS cover the '
+                   'application classes too.')
+@click.option('--ready-timeout', type=int, default=600,
+              help='Seconds to wait for the FHIR metadata endpoint after hapi-start. 0 to not wait.')
 @click.pass_context
 def command(
         ctx: click.Context,
         work_dir,
         git_url,
         git_ref,
+        git_mirror,
         hapi_port,
         mvn_local_repo,
         mvn_rebuild,
+        mvn_strategy,
+        mvn_threads,
+        mvn_skip_tests,
+        mvnd,
+        build_cache,
+        build_cache_size,
         dbs_work_dir,
+        dbs_database,
+        dbs_pooler,
+        jdbc_pool_size,
+        jdbc_min_idle,
+        jdbc_connection_timeout,
+        jdbc_max_lifetime,
+        jdbc_statement_cache,
         action,
 
         java_debug,
@@ -82,18 +167,39 @@ def command(
         java_debug_ip,
         java_debug_port,
 
-        spring_profiles
+        spring_profiles,
+        jvm_profile,
+        jvm_heap,
+        jvm_opt,
+        app_cds,
+        exploded_war,
+        ready_timeout
 ):
     actions: Actions = ctx.obj
     state: HapiJpaStarterState = actions.get_action_state(work_dir or ctx.command.name, HapiJpaStarterState)
 
-    params = state.params
+    # a fresh params object since a chain can hold several invocations for the same state
+    params = state.params = HapiJpaStarterParams()
     params.git_url = git_url
     params.git_ref = git_ref
+    params.git_mirror = git_mirror
     params.hapi_port = hapi_port
     params.mvn_local_repo = mvn_local_repo
     params.mvn_rebuild = mvn_rebuild
+    params.mvn_strategy = mvn_strategy
+    params.mvn_threads = mvn_threads
+    params.mvn_skip_tests = mvn_skip_tests
+    params.mvnd = mvnd
+    params.build_cache = build_cache
+    params.build_cache_size = build_cache_size
     params.dbs_work_dir = dbs_work_dir
+    params.dbs_database = dbs_database
+    params.dbs_pooler = dbs_pooler
+    params.jdbc_pool_size = jdbc_pool_size
+    params.jdbc_min_idle = jdbc_min_idle
+    params.jdbc_connection_timeout = jdbc_connection_timeout
+    params.jdbc_max_lifetime = jdbc_max_lifetime
+    params.jdbc_statement_cache = jdbc_statement_cache
     params.actions = action
 
     params.java_debug = java_debug
@@ -103,18 +209,45 @@ def command(
     params.java_debug_port = java_debug_port
 
     params.spring_profiles = spring_profiles
+    params.ready_timeout = ready_timeout
+    params.jvm_profile = jvm_profile
+    params.jvm_heap = jvm_heap
+    params.jvm_opts = list(jvm_opt)
+    params.app_cds = app_cds
+    params.exploded_war = exploded_war
 
     hapi = HapiJpaStarterAction(actions, state)
-    hapi.run()
+    graph = get_action_graph(ctx)
+    if graph is not None:
+        hapi.schedule(graph)
+    else:
+        hapi.run()
 
 
 MAVEN_DIR = pathlib.Path('apache-maven-3.8.6')
 MAVEN_TAR_GZ = pathlib.Path(f'{MAVEN_DIR}-bin.tar.gz')
 MAVEN_URL = f'https://archive.apache.org/dist/maven/maven-3/3.8.6/binaries/{MAVEN_TAR_GZ}'
+MAVEN_PROFILE = 'boot'
+MAVEN_LOG = 'maven.log'
+MAVEN_BUILDING = re.compile(r'^\[INFO\] Building (?!\w+: )(\S+)(?: \S+)?(?:\s+\[(\d+/\d+)\])?')
+MAVEN_GOAL = re.compile(r'^\[INFO\] --- (\S+) .*@ (\S+) ---')
 
 # HAPI_GIT_URL = 'https://github.com/hapifhir/hapi-fhir-jpaserver-starter.git'
 HAPI_GIT_DIR = pathlib.Path('hapi-jpa-starter')
 HAPI_RUN_DIR = 'hapi-run'
+HAPI_EXPLODED_DIR = 'exploded'
+HAPI_LOG = 'hapi.log'
+HAPI_OUTPUT_REPORT = 'hapi-output.json'
+# the embedded H2 database of the starter's default datasource (jdbc:h2:file:./target/database/h2), in the run dir
+HAPI_H2_DIR = pathlib.Path('target') / 'database'
+# errors after which HAPI won't become ready
+HAPI_FATAL_ERRORS = {'startup-failed', 'jvm-error'}
+
+JVM_PROFILES = {
+    'default': [],
+    'fast-start': ['-XX:TieredStopAtLevel=1', '-XX:+UseSerialGC', '-XX:-UsePerfData'],
+    'throughput': ['-XX:+UseG1GC', '-XX:+UseStringDeduplication'],
+}
 
 
 class HapiJpaStarterAction(Action[HapiJpaStarterState]):
@@ -143,29 +276,62 @@ class HapiJpaStarterAction(Action[HapiJpaStarterState]):
         if self.state.params.dbs_work_dir is not None:
             self.db_server = self.actions.get_action_state(self.state.params.dbs_work_dir, setupservers.DBServerState)
 
-    def run(self):
-
-        for action in self.state.params.actions:
-            if action == 'hapi-start':
-                self._hapi_start()
-            elif action == 'hapi-stop':
-                self._hapi_stop()
-
-    def _hapi_start(self):
-        self._hapi_build_prepare()
+        self.port_registry: PortRegistry = PortRegistry()
+        self._prepared = False
 
-        if self.state.pid is not None and not setupservers.pid_exists(self.state.pid):
+    def run(self):
+        with self.state.batch():
+            for action in self.state.params.actions:
+                if action == 'hapi-start':
+                    self._hapi_start()
+                elif action == 'hapi-stop':
+                    self._hapi_stop()
+
+    def schedule(self, graph: ActionGraph):
+        # the checkout and build only touch this work dir so they can overlap with the database start. Starting the
+        # JVM is what needs the linked database.
+        params = self.state.params
+
+        def with_params(fn):
+            def run():
+                # steps on the same state run in chain order, each with the params it was invoked with
+                self.state.params = params
+                with self.state.batch():
+                    fn()
+            return run
+
+        work_dirs = [self.state.path]
+        if params.actions and params.actions[0] == 'hapi-start':
+            graph.add(f"hapi-jpa-starter {self.state.path.name} build", with_params(self._hapi_prepare), work_dirs)
+        if self.db_server is not None:
+            work_dirs.append(self.db_server.path)
+        graph.add(f"hapi-jpa-starter {self.state.path.name}", with_params(self.run), work_dirs)
+
+    @traced('hapi-jpa-starter prepare')
+    def _hapi_prepare(self):
+        if self.state.pid is not None and (setupservers.reap_child(self.state.pid)
+                                           or not setupservers.pid_exists(self.state.pid)):
+            # keep what the log said about why it is gone
+            self._read_output_report()
             self.state.pid = None
             self.state.status = 'stopped'
 
+        if self._prepared:
+            return
+        self._hapi_build_prepare()
+
         if self.state.git_sha != self.requested_sha or self.state.params.mvn_rebuild:
             # we need to rebuild
             if self.state.status == 'running':
                 raise Exception('Requested to start hapi with a different build but it is running. Stop hapi first.')
             self._hapi_build()
-        else:
-            if self.state.status == 'running':
-                return
+        self._prepared = True
+
+    @traced('hapi-start')
+    def _hapi_start(self):
+        self._hapi_prepare()
+        if self.state.status == 'running':
+            return
 
         with open(self.hapi_run_path / 'application-local.yaml') as f:
             hapi_local_config = yaml.safe_load(f)
@@ -175,7 +341,12 @@ class HapiJpaStarterAction(Action[HapiJpaStarterState]):
         if 'server' not in hapi_local_config:
             hapi_local_config['server'] = {}
 
-        port = setupservers.find_free_port('localhost', self.state.params.hapi_port)
+        # the HAPI and debugger ports are leased together so a concurrent start can't take either of them
+        port_requests = {'hapi': ('localhost', self.state.params.hapi_port)}
+        if self.state.params.java_debug:
+            port_requests['debug'] = (self.state.params.java_debug_ip, int(self.state.params.java_debug_port))
+        ports = self.port_registry.allocate(self.state.path, port_requests)
+        port = ports['hapi']
 
         hapi_local_config['server']['port'] = port
 
@@ -199,35 +370,193 @@ class HapiJpaStarterAction(Action[HapiJpaStarterState]):
                 f'-Dspring.profiles.active={self.state.params.spring_profiles}',
                 f'-Dlogging.config={str(self.hapi_run_path / "logback.xml")}'
                 ]
+        self.state.jvm_args = self._jvm_args()
+        args.extend(self.state.jvm_args)
 
         if self.state.params.java_debug:
             server = 'n' if self.state.params.java_debug_attach else 'y'
             suspend = 'y' if self.state.params.java_debug_suspend else 'n'
             address = self.state.params.java_debug_ip
-            port = setupservers.find_free_port(address, int(self.state.params.java_debug_port))
+            port = ports['debug']
             agent = f"-agentlib:jdwp=transport=dt_socket,server={server},suspend={suspend},address={address}:{port}"
             args.append(agent)
             self.logger.info(f"HAPI {self.state.path.name} debugger configured as: {agent}")
 
-        args.extend([
-            '-jar',
-            'ROOT.war'
-        ])
+        args.extend(self._jvm_main())
 
         if self.db_server is not None and self.db_server.dbs_type == 'postgres':
-            args.extend([
-                f'--spring.datasource.url=jdbc:postgresql://localhost:{self.db_server.dbs_port}/postgres',
-                '--spring.datasource.username=postgres',
-                '--spring.datasource.password=postgres',
-                '--spring.datasource.driverClassName=org.postgresql.Driver',
-                '--spring.jpa.properties.hibernate.dialect=ca.uhn.fhir.jpa.model.dialect.HapiFhirPostgres94Dialect'
-            ])
-        p = subprocess.Popen(args, cwd=self.hapi_run_path)
+            args.extend(self._datasource_args())
+        with span('jvm launch'):
+            p = self._launch(args)
+        self.port_registry.update(self.state.path, pid=p.pid)
         self.state.pid = p.pid
         self.state.status = 'running'
-        self.state.save()
+        self.state.fhir_ready_seconds = None
+        self.state.fhir_started_seconds = None
+        self.state.fhir_errors = []
+        self.state.dbs_work_dir = str(self.db_server.path) if self.db_server is not None else None
+        self.state.dbs_database = self.state.params.dbs_database if self.db_server is not None else None
+        # written right away, a stop from another invocation needs the pid while this one waits for readiness
+        self.state.flush()
         self.logger.info(f"HAPI FHIR endpoint starting on: {self.state.fhir_url}")
 
+        if self.state.params.ready_timeout:
+            def ready():
+                report = self._read_output_report()
+                errors = ''.join(f'\n  {error}' for error in self.state.fhir_errors)
+                if p.poll() is not None:
+                    raise Exception(f'HAPI exited with code {p.returncode} before it was ready. See '
+                                    f'{self.hapi_run_path / HAPI_LOG}{errors}')
+                if report and any(error['kind'] in HAPI_FATAL_ERRORS for error in report['errors']):
+                    raise Exception(f'HAPI failed to start. See {self.hapi_run_path / HAPI_LOG}{errors}')
+                return setupservers.is_http_ready(self.state.fhir_url + '/metadata')
+
+            try:
+                with span('hapi readiness', url=self.state.fhir_url):
+                    self.state.fhir_ready_seconds = setupservers.wait_until(
+                        ready, timeout=self.state.params.ready_timeout, interval=1)
+            finally:
+                self._read_output_report()
+                self.state.save()
+            self.logger.info(f"HAPI FHIR endpoint ready after {self.state.fhir_ready_seconds:.1f}s, Spring Boot "
+                             f"reported {self.state.fhir_started_seconds}s")
+
+    def _datasource_args(self) -> t.List[str]:
+        params = self.state.params
+        db_server = self.db_server
+        host, port = 'localhost', db_server.dbs_port
+        driver_properties = {}
+        if params.dbs_pooler and db_server.pooler_port:
+            host, port = db_server.pooler_host or host, db_server.pooler_port
+            if db_server.pooler_mode == 'transaction':
+                # server side prepared statements don't survive switching server connections between transactions
+                driver_properties['prepareThreshold'] = '0'
+            self.logger.info(f"HAPI connects through the {db_server.pooler_mode} pooler on {host}:{port}")
+        if params.jdbc_statement_cache is not None:
+            driver_properties['preparedStatementCacheQueries'] = str(params.jdbc_statement_cache)
+
+        database, user, password = 'postgres', db_server.dbs_user or 'postgres', db_server.dbs_pass or 'postgres'
+        if params.dbs_database:
+            if params.dbs_database not in db_server.databases:
+                raise Exception(f'No database {params.dbs_database} in {db_server.path}, create it with '
+                                f'postgres-docker --action db-create --database {params.dbs_database}.')
+            database = params.dbs_database
+            owner = db_server.users[db_server.databases[database].owner]
+            user, password = owner.name, owner.password
+        url = f'jdbc:postgresql://{host}:{port}/{database}'
+
+        args = [
+            f'--spring.datasource.url={url}',
+            f'--spring.datasource.username={user}',
+            f'--spring.datasource.password={password}',
+            '--spring.datasource.driverClassName=org.postgresql.Driver',
+            '--spring.jpa.properties.hibernate.dialect=ca.uhn.fhir.jpa.model.dialect.HapiFhirPostgres94Dialect'
+        ]
+        hikari = {
+            'maximum-pool-size': params.jdbc_pool_size,
+            'minimum-idle': params.jdbc_min_idle,
+            'connection-timeout': params.jdbc_connection_timeout,
+            'max-lifetime': params.jdbc_max_lifetime,
+        }
+        args.extend(f'--spring.datasource.hikari.{name}={value}' for name, value in hikari.items() if value is not None)
+        args.extend(f'--spring.datasource.hikari.data-source-properties.{name}={value}'
+                    for name, value in driver_properties.items())
+
+        if port == db_server.dbs_port:
+            self._check_connection_budget()
+        return args
+
+    def _check_connection_budget(self):
+        """Warn when the pools of the HAPIs linked directly to the database can outgrow its max_connections."""
+        max_connections = int(getattr(self.db_server, 'dbs_settings', {}).get('max_connections', 100))
+        # HikariCP's default maximum-pool-size
+        pool_size = self.state.params.jdbc_pool_size or 10
+        others = StateIndex().find(type='fhir', status='running', dbs_work_dir=self.db_server.path)
+        others.pop(self.state.path, None)
+        if pool_size * (len(others) + 1) > max_connections:
+            self.logger.warning(f"{len(others) + 1} HAPIs with pools of up to {pool_size} connections can exhaust the "
+                                f"{max_connections} connections of {self.db_server.path}. Consider --pgbouncer on "
+                                f"postgres-docker or a smaller --jdbc-pool-size.")
+
+    def _launch(self, args: t.List[str]) -> subprocess.Popen:
+        """Start the JVM with its output piped to a detached hapi_output process, which keeps writing the log after
+        this command exits.
+        """
+        report_path = self.hapi_run_path / HAPI_OUTPUT_REPORT
+        if report_path.exists():
+            report_path.unlink()
+        read_fd, write_fd = os.pipe()
+        try:
+            # the reader first, the JVM must never write to a pipe nobody reads
+            subprocess.Popen([sys.executable, '-m', 'setupservers.hapi_output', str(self.hapi_run_path / HAPI_LOG),
+                              str(report_path)],
+                             stdin=read_fd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                             start_new_session=True)
+            return subprocess.Popen(args, cwd=self.hapi_run_path, stdin=subprocess.DEVNULL, stdout=write_fd,
+                                    stderr=subprocess.STDOUT)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def _read_output_report(self) -> t.Optional[t.Dict[str, t.Any]]:
+        report = read_report(self.hapi_run_path / HAPI_OUTPUT_REPORT)
+        if report is not None:
+            self.state.fhir_started_seconds = report['started_seconds']
+            self.state.fhir_errors = [f"{error['kind']}: {error['line']}" for error in report['errors']]
+        return report
+
+    def _jvm_args(self) -> t.List[str]:
+        params = self.state.params
+        args = list(JVM_PROFILES[params.jvm_profile or 'default'])
+        if params.jvm_heap:
+            args.append(f'-Xmx{params.jvm_heap}')
+        args.extend(params.jvm_opts or [])
+
+        if params.app_cds:
+            # one archive per installed WAR, archives of earlier WARs no longer match the classpath
+            archive = self.hapi_run_path / f'app-cds-{self._war_id()}.jsa'
+            for stale in self.hapi_run_path.glob('app-cds-*.jsa'):
+                if stale != archive:
+                    stale.unlink()
+            if archive.exists():
+                args.append(f'-XX:SharedArchiveFile={archive}')
+            else:
+                self.logger.info("No AppCDS archive for this build yet, recording one until HAPI stops.")
+                args.append(f'-XX:ArchiveClassesAtExit={archive}')
+        return args
+
+    def _jvm_main(self) -> t.List[str]:
+        if not self.state.params.exploded_war:
+            return ['-jar', 'ROOT.war']
+
+        exploded = self.hapi_run_path / HAPI_EXPLODED_DIR
+        stamp = exploded / '.war_id'
+        war_id = self._war_id()
+        if not stamp.exists() or stamp.read_text() != war_id:
+            shutil.rmtree(exploded, ignore_errors=True)
+            with zipfile.ZipFile(self.hapi_run_path / 'ROOT.war') as war:
+                war.extractall(exploded)
+            stamp.write_text(war_id)
+
+        start_class = None
+        with open(exploded / 'META-INF' / 'MANIFEST.MF') as f:
+            for line in f:
+                if line.startswith('Start-Class:'):
+                    start_class = line.split(':', 1)[1].strip()
+        if start_class is None:
+            raise Exception('ROOT.war has no Start-Class in its manifest, it can not be run exploded.')
+
+        web_inf = exploded / 'WEB-INF'
+        classpath = [str(web_inf / 'classes'), str(web_inf / 'lib' / '*'), str(web_inf / 'lib-provided' / '*')]
+        return ['-cp', os.pathsep.join(classpath), start_class]
+
+    def _war_id(self) -> str:
+        """Identifies the installed ROOT.war. Rebuilds and cached builds with other Maven settings install another WAR
+        for the same git sha, each linked or copied in as a new file."""
+        stat = (self.hapi_run_path / 'ROOT.war').stat()
+        return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+    @traced('hapi-stop')
     def _hapi_stop(self):
         if self.state.pid is None:
             self.logger.info("HAPI already stopped.")
@@ -238,27 +567,45 @@ class HapiJpaStarterAction(Action[HapiJpaStarterState]):
             if err.errno == errno.ESRCH:
                 self.logger.info("HAPI not running but state file is not up to date.")
 
-        for i in range(10):
-            try:
-                os.kill(self.state.pid, 0)
-                time.sleep(i)
-            except OSError as err:
-                if err.errno == errno.ESRCH:
-                    # no such process
-                    break
-                else:
-                    # some other error
-                    raise err
+        def exited():
+            # a JVM started by this process, e.g. earlier in the same chain, has to be reaped to leave the table
+            return setupservers.reap_child(self.state.pid) or not setupservers.pid_exists(self.state.pid)
+
+        try:
+            setupservers.wait_until(exited, timeout=45)
+        except TimeoutError:
+            self.logger.warning(f"HAPI process {self.state.pid} did not exit after SIGTERM.")
+        self._read_output_report()
         self.state.pid = None
         self.state.status = 'stopped'
         self.state.save()
+        self.port_registry.release(self.state.path)
         self.logger.info(f"HAPI stopped")
 
-    def _hapi_build_prepare(self):
-        # install maven if needed
+    @traced('maven install')
+    def _maven_install(self):
         if not self.maven_home.exists():
-            setupservers.download_file(MAVEN_URL, self.state.path / MAVEN_TAR_GZ)
-            setupservers.unpack_targz(self.state.path / MAVEN_TAR_GZ, self.state.path)
+            maven_tar_gz = cached_download(MAVEN_URL, f'{MAVEN_URL}.sha512')
+            if self.maven_home.is_symlink():
+                # the shared copy was removed from the cache
+                self.maven_home.unlink()
+            try:
+                self.maven_home.symlink_to(cached_unpack(maven_tar_gz) / MAVEN_DIR, target_is_directory=True)
+            except OSError:
+                # no symlinks (e.g. Windows without developer mode), extract into the work dir
+                setupservers.unpack_targz(maven_tar_gz, self.state.path)
+
+    @traced('hapi checkout')
+    def _hapi_build_prepare(self):
+        # GitPython is only imported by the actions that check out
+        import git
+        from git import Repo
+        from setupservers.git_mirror import GitMirror
+
+        if self.state.params.git_mirror:
+            mirror = GitMirror(self.state.params.git_url, self.logger)
+            self.requested_sha = mirror.checkout(self.state.params.git_ref, self.hapi_repo)
+            return
 
         # clone and checkout hapi starter
         if not self.hapi_repo.exists():
@@ -280,40 +627,128 @@ class HapiJpaStarterAction(Action[HapiJpaStarterState]):
         self.requested_sha = repo.head.object.hexsha
         repo.close()
 
+    @traced('hapi build')
     def _hapi_build(self):
-        # build and install
-        completed: Union[CompletedProcess[Any], CompletedProcess[bytes]] = subprocess.run(
-            [
-                self.mvn_cmd,
-                f'-Dmaven.repo.local={str(self.maven_repo)}',
-                '-U',
-                '-f',
-                str(self.hapi_repo / 'pom.xml'),
-                '-Pboot',
-                'clean',
-                'package'
-            ],
-            capture_output=True)
-        self._log_subprocess_output(completed)
-        if completed.returncode != 0:
-            raise Exception(f'Maven build failed with exit code {completed.returncode}. See log files.')
-
-        shutil.copy(src=self.hapi_repo / 'target' / 'ROOT.war', dst=self.hapi_run_path / 'ROOT.war')
-        shutil.copy(src=self.hapi_repo / 'src' / 'main' / 'resources' / 'application.yaml',
-                    dst=self.hapi_run_path / 'application.yaml')
+        if not self.state.params.build_cache or self.state.params.mvn_rebuild:
+            # a rebuild can include local changes, it must not replace the cached build of the clean sha
+            self._mvn_package()
+            self._hapi_install_build(self.hapi_repo / 'target' / 'ROOT.war',
+                                     self.hapi_repo / 'src' / 'main' / 'resources')
+        else:
+            cache = DirectoryCache('hapi-builds', max_entries=self.state.params.build_cache_size)
+            key = self._build_key()
+            # holding the lock while building means concurrent runs for the same key wait for one build
+            with cache.lock(key):
+                entry = cache.get(key)
+                if entry is None:
+                    self._mvn_package()
+                    entry = cache.put(key, self._hapi_cache_build)
+                else:
+                    self.logger.info(f"Using cached HAPI build {key[:12]} for {self.requested_sha}")
+                self._hapi_install_build(entry / 'ROOT.war', entry)
+
+        self.state.git_sha = self.requested_sha
+        self.state.status = 'built'
+        self.state.save()
+
+    @traced('mvn package')
+    def _mvn_package(self):
+        args = self._mvn_args()
+        self.logger.info(f"Maven build: {' '.join(args)}")
+        progress = _MavenProgress(self.logger)
+        output = OutputLog(self.state.path / 'logs' / MAVEN_LOG, on_line=progress.on_line)
+        self.logger.info(f"Maven output is written to {output.path}")
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            output.pump(process.stdout)
+        finally:
+            returncode = process.wait()
+        self.logger.info(f"Maven {self.state.params.mvn_strategy} build took {progress.elapsed():.1f}s")
+        if returncode != 0:
+            self.logger.error(f"Maven build failed, last lines of {output.path}:\n{output.tail_text(50)}")
+            raise Exception(f'Maven build failed with exit code {returncode}. See {output.path}.')
+
+    def _build_key(self) -> str:
+        """The build cache key: the sources and the settings that change what Maven produces."""
+        params = self.state.params
+        mvnd = self._mvnd_cmd()
+        # the resolved mvnd path names its installation, and with it the Maven version it embeds
+        maven = os.path.realpath(mvnd) if mvnd is not None else MAVEN_DIR.name
+        return DirectoryCache.key(self.requested_sha, maven, MAVEN_PROFILE, params.mvn_strategy or 'clean',
+                                  bool(params.mvn_skip_tests))
+
+    def _mvnd_cmd(self) -> t.Optional[str]:
+        if not self.state.params.mvnd:
+            return None
+        if not hasattr(self, '_mvnd'):
+            self._mvnd = shutil.which('mvnd')
+            if self._mvnd is None:
+                self.logger.warning("mvnd was requested but is not on the PATH, using Maven.")
+        return self._mvnd
+
+    def _mvn_args(self) -> t.List[str]:
+        params = self.state.params
+        mvn_cmd = self._mvnd_cmd()
+        if mvn_cmd is None:
+            self._maven_install()
+            mvn_cmd = self.mvn_cmd
+
+        # batch mode, no colors or download progress in the log
+        args = [mvn_cmd, '-B', f'-Dmaven.repo.local={str(self.maven_repo)}']
+
+        strategy = params.mvn_strategy or 'clean'
+        if strategy == 'offline':
+            if self.maven_repo.exists() and any(self.maven_repo.iterdir()):
+                args.append('-o')
+            else:
+                self.logger.info("Local Maven repository is empty, building online this time.")
+        elif strategy == 'clean':
+            args.append('-U')
+
+        if params.mvn_threads:
+            args.extend(['-T', params.mvn_threads])
+        if params.mvn_skip_tests:
+            args.append('-DskipTests')
+
+        args.extend(['-f', str(self.hapi_repo / 'pom.xml'), f'-P{MAVEN_PROFILE}'])
+        if strategy == 'clean':
+            args.append('clean')
+        args.append('package')
+        return args
+
+    def _hapi_cache_build(self, entry_path: Path):
+        resources = self.hapi_repo / 'src' / 'main' / 'resources'
+        shutil.copy(src=self.hapi_repo / 'target' / 'ROOT.war', dst=entry_path / 'ROOT.war')
+        shutil.copy(src=resources / 'application.yaml', dst=entry_path / 'application.yaml')
+        shutil.copy(src=resources / 'logback.xml', dst=entry_path / 'logback.xml')
+
+    def _hapi_install_build(self, war: Path, resources: Path):
+        setupservers.link_or_copy(war, self.hapi_run_path / 'ROOT.war')
+        shutil.copy(src=resources / 'application.yaml', dst=self.hapi_run_path / 'application.yaml')
         if not (self.hapi_run_path / 'application-local.yaml').exists():
             with open(self.hapi_run_path / 'application-local.yaml', 'w'):
                 pass
         if not (self.hapi_run_path / 'logback.xml').exists():
-            shutil.copy(src=self.hapi_repo / 'src' / 'main' / 'resources' / 'logback.xml',
-                        dst=self.hapi_run_path / 'logback.xml')
+            shutil.copy(src=resources / 'logback.xml', dst=self.hapi_run_path / 'logback.xml')
 
-        self.state.git_sha = self.requested_sha
-        self.state.status = 'built'
-        self.state.save()
 
-    def _log_subprocess_output(self, completed: CompletedProcess):
-        for line in completed.stdout.splitlines():
-            self.logger.debug(line.decode('utf-8'))
-        for line in completed.stderr.splitlines():
-            self.logger.error(line.decode('utf-8'))
+class _MavenProgress(object):
+    """Logs the module and plugin goal a Maven build is at, from its output lines."""
+
+    def __init__(self, logger: logging.Logger):
+        self.logger: logging.Logger = logger
+        self.start = time.monotonic()
+        self.position: t.Optional[str] = None
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    def on_line(self, line: str):
+        building = MAVEN_BUILDING.match(line)
+        if building:
+            self.position = building.group(2)
+            return
+        goal = MAVEN_GOAL.match(line)
+        if goal:
+            position = f' [{self.position}]' if self.position else ''
+            self.logger.info(f"Maven {self.elapsed():6.1f}s {goal.group(2)}{position} {goal.group(1)}")
@@ -0,0 +1,75 @@
+import json
+import statistics
+import subprocess
+import sys
+import time
+import typing as t
+
+import click
+from clickactions import Command, Actions
+
+# what loading the CLI must not import, they are deferred until an action needs them
+HEAVY_MODULES = ['docker', 'git', 'requests', 'pydevd', 'tarfile']
+
+CLI_HELP = 'from setupservers.commands import commands; commands(["--help"])'
+
+
+@click.command(name='import-bench', cls=Command)
+@click.option('--runs', type=int, default=10)
+@click.option('--module', default='setupservers.commands', help='Module whose import is timed.')
+@click.option('--forbid', multiple=True, help='Modules the import must not load. Defaults to '
+                                              f'{", ".join(HEAVY_MODULES)}.')
+@click.option('--max-import-ms', type=float, help='Fail when the median import time is higher.')
+@click.option('--max-help-ms', type=float, help='Fail when the median wall time of setup-servers --help is higher.')
+@click.option('--top', type=int, default=10, help='How many of the slowest imported modules to report.')
+@click.pass_context
+def command(ctx: click.Context, runs, module, forbid, max_import_ms, max_help_ms, top):
+    """Time importing the CLI and running --help in fresh interpreters. Fails on a budget or forbidden import."""
+    actions: Actions = ctx.obj
+    forbid = list(forbid) or HEAVY_MODULES
+
+    import_ms = []
+    help_ms = []
+    modules: t.Dict[str, int] = {}
+    for _ in range(runs):
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                   capture_output=True, text=True, check=True)
+        modules = _import_times(completed.stderr)
+        import_ms.append(modules.get(module, 0) / 1000)
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', CLI_HELP], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        help_ms.append((time.perf_counter() - start) * 1000)
+
+    report = {
+        'module': module,
+        'runs': runs,
+        'import_ms': statistics.median(import_ms),
+        'help_ms': statistics.median(help_ms),
+        'forbidden_imports': [name for name in forbid if name in modules],
+        'slowest': dict(sorted(((name, us) for name, us in modules.items() if name != module),
+                               key=lambda item: -item[1])[:top]),
+    }
+    click.echo(json.dumps(report, indent=2))
+
+    problems = []
+    if report['forbidden_imports']:
+        problems.append(f"importing {module} loads {', '.join(report['forbidden_imports'])}")
+    if max_import_ms is not None and report['import_ms'] > max_import_ms:
+        problems.append(f"import took {report['import_ms']:.0f}ms, more than {max_import_ms:.0f}ms")
+    if max_help_ms is not None and report['help_ms'] > max_help_ms:
+        problems.append(f"--help took {report['help_ms']:.0f}ms, more than {max_help_ms:.0f}ms")
+    if problems:
+        raise click.ClickException('Import time regression: ' + '; '.join(problems))
+    actions.logger.info(f"Import of {module}: {report['import_ms']:.0f}ms, --help: {report['help_ms']:.0f}ms")
+
+
+def _import_times(importtime_output: str) -> t.Dict[str, int]:
+    """Cumulative microseconds per module from python -X importtime output."""
+    modules = {}
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative)
+    return modules
@@ -1,21 +1,35 @@
 # from __future__ import annotations
 import os
 import platform
-import time
+import secrets
+import shutil
 import typing as t
 from pathlib import Path
 
 import click
-import docker
+import yaml
 from clickactions import Actions, Command, Action
-from docker.errors import NotFound
-from docker.models.containers import Container
-from docker.types.containers import ContainerConfig
+
+if t.TYPE_CHECKING:
+    # imported with the Docker client when an action needs it
+    import docker
+    from docker.models.containers import Container
 
 import setupservers
 import setupservers.util
 from setupservers import DBServerState
+from setupservers.states import DBUser, DBDatabase
+from setupservers.cache import DirectoryCache
+from setupservers.docker_client import docker_client, container_statuses
+from setupservers.graph import ActionGraph, get_action_graph
+from setupservers.pg_pool import PostgresPool
+from setupservers.ports import PortRegistry
+from setupservers.state_index import StateIndex
+from setupservers.tracing import traced, span
+
 
+# the environment contract (AUTH_TYPE, AUTH_USER, LISTEN_PORT, ...) of _pooler_start is this release's
+PGBOUNCER_IMAGE = 'edoburu/pgbouncer:v1.23.1-p2'
 
 # pydevd.settrace(host='localhost', port=5678, stdoutToServer=True, stderrToServer=UnicodeTranslateError,
 #                 suspend=False)
@@ -33,6 +47,20 @@ class PostgresDockerParams(object):
         self.actions: t.Optional[t.List] = []
         self.unsafe: t.Optional[bool] = False
         self.interactive: t.Optional[bool] = False
+        self.ready_timeout: t.Optional[int] = None
+        self.dbs_profile: t.Optional[str] = None
+        self.snapshot: t.Optional[str] = None
+        self.snapshot_cache_size: t.Optional[int] = None
+        self.pgbouncer: t.Optional[bool] = False
+        self.pgbouncer_tag: t.Optional[str] = None
+        self.pgbouncer_port: t.Optional[int] = None
+        self.pgbouncer_pool_mode: t.Optional[str] = None
+        self.pgbouncer_pool_size: t.Optional[int] = None
+        self.pgbouncer_max_client_conn: t.Optional[int] = None
+        self.databases: t.Optional[t.List[str]] = []
+        self.database_user: t.Optional[str] = None
+        self.database_pass: t.Optional[str] = None
+        self.pool: t.Optional[str] = None
 
 
 class PostgresDockerState(DBServerState):
@@ -50,10 +78,32 @@ class PostgresDockerState(DBServerState):
             self.docker_tag: t.Optional[str] = None
         if not hasattr(self, 'docker_uid'):
             self.docker_uid: t.Optional[str] = None
+        if not hasattr(self, 'docker_auto_remove'):
+            self.docker_auto_remove: t.Optional[bool] = None
+        if not hasattr(self, 'dbs_profile'):
+            self.dbs_profile: t.Optional[str] = None
+        if not hasattr(self, 'dbs_settings'):
+            self.dbs_settings: t.Dict[str, str] = {}
+        if not hasattr(self, 'dbs_snapshot'):
+            self.dbs_snapshot: t.Optional[str] = None
+        if not hasattr(self, 'pooler_container_uuid'):
+            self.pooler_container_uuid: t.Optional[str] = None
+        if not hasattr(self, 'dbs_initial_databases'):
+            # the databases initdb created, recorded for pool members to restore on their return
+            self.dbs_initial_databases: t.List[str] = []
+        if not hasattr(self, 'pool_name'):
+            # the warm pool the container was claimed from
+            self.pool_name: t.Optional[str] = None
 
     def _clear(self):
         self.container_uuid = None
+        self.pooler_container_uuid = None
+        self.pool_name = None
+        self.dbs_initial_databases = []
         self.container_name = None
+        self.docker_auto_remove = None
+        self.dbs_profile = None
+        self.dbs_settings = {}
         self.docker_tag = None
         self.docker_uid = None
         super(PostgresDockerState, self)._clear()
@@ -71,14 +121,49 @@ class PostgresDockerState(DBServerState):
 @click.option("--action",
               multiple=True,
               help="Various actions in desired order. Few imply others. Current actions: "
-                   "dbs-start, dbs-stop, docker-remove.")
+                   "dbs-start, dbs-stop, docker-remove, dbs-snapshot, dbs-clone, db-create, db-drop.")
+@click.option("--snapshot",
+              help="Name for dbs-snapshot, or the name or key of the snapshot to copy with dbs-clone.")
+@click.option("--snapshot-cache-size", type=int, default=10, help="Maximum number of snapshots kept in the cache.")
 @click.option("--unsafe", is_flag=True)
 @click.option("--interactive", is_flag=True)
+@click.option("--dbs-profile", type=click.Choice(['durable', 'ephemeral', 'throughput']),
+              help="Defaults to durable, or to ephemeral with --pool. durable: stock settings on the docker-volume "
+                   "bind mount. ephemeral: PGDATA on tmpfs with fsync, synchronous_commit and full_page_writes off, "
+                   "the data is lost when the container stops. "
+                   "throughput: memory, connection, WAL and parallelism settings sized from the host's CPUs and RAM. "
+                   "Applied when the container is created.")
+@click.option("--ready-timeout", type=int, default=60,
+              help="Seconds to wait for PostgreSQL to accept connections after dbs-start. 0 to not wait.")
+@click.option("--pgbouncer", is_flag=True,
+              help="Also run a PgBouncer container in front of PostgreSQL with dbs-start. Clients linked with "
+                   "--dbs-work-dir connect through it. It is removed by dbs-stop and docker-remove.")
+@click.option("--pgbouncer-tag", default=PGBOUNCER_IMAGE,
+              help="The PgBouncer image. Other edoburu/pgbouncer releases may read other environment variables.")
+@click.option("--pgbouncer-port", type=int, default=6432)
+@click.option("--pgbouncer-pool-mode", type=click.Choice(['session', 'transaction']), default='transaction',
+              help="transaction: a server connection per transaction, linked HAPIs then turn off server side "
+                   "prepared statements.")
+@click.option("--pgbouncer-pool-size", type=int, default=20, help="Server connections per database and user.")
+@click.option("--pgbouncer-max-client-conn", type=int, default=1000)
+@click.option("--database", "databases", multiple=True,
+              help="Databases for db-create and db-drop, each in the running server. Clients select one with "
+                   "hapi-jpa-starter --dbs-database.")
+@click.option("--database-user", help="The role owning the databases db-create creates. Defaults to a role named "
+                                      "after each database. db-drop drops a role with its last database.")
+@click.option("--database-pass", help="The password of a role db-create creates or updates. Generated by default.")
+@click.option("--pool", help="A postgres-pool warm pool. dbs-start claims an idle container from it instead of "
+                             "creating one and refills the pool in the background. dbs-stop, also without --pool, "
+                             "resets a claimed container and returns it to its pool while the pool has room. Pooled "
+                             "containers use the ephemeral profile, with another --dbs-profile a container is created "
+                             "instead.")
 @click.pass_context
 def command(
         click_context: click.Context, work_dir, docker_tag, docker_uid, docker_auto_remove,
-        dbs_user, dbs_pass, dbs_host, dbs_port, action,
-        unsafe, interactive,
+        dbs_user, dbs_pass, dbs_host, dbs_port, action, snapshot, snapshot_cache_size,
+        unsafe, interactive, dbs_profile, ready_timeout, pgbouncer, pgbouncer_tag, pgbouncer_port,
+        pgbouncer_pool_mode, pgbouncer_pool_size, pgbouncer_max_client_conn, databases, database_user, database_pass,
+        pool,
 ):
     actions: Actions = click_context.obj
     if work_dir is None:
@@ -86,7 +171,8 @@ def command(
 
     state: PostgresDockerState = actions.get_action_state(Path(work_dir) or Path(click_context.command.name),
                                                           PostgresDockerState)
-    params = state.params
+    # a fresh params object since a chain can hold several invocations for the same state
+    params = state.params = PostgresDockerParams()
 
     params.docker_tag = docker_tag
     params.docker_uid = docker_uid
@@ -96,11 +182,67 @@ def command(
     params.dbs_host = dbs_host
     params.dbs_port = dbs_port
     params.actions = action
+    params.snapshot = snapshot
+    params.snapshot_cache_size = snapshot_cache_size
     params.unsafe = unsafe
     params.interactive = interactive
+    params.ready_timeout = ready_timeout
+    params.dbs_profile = dbs_profile or ('ephemeral' if pool else 'durable')
+    params.pgbouncer = pgbouncer
+    params.pgbouncer_tag = pgbouncer_tag
+    params.pgbouncer_port = pgbouncer_port
+    params.pgbouncer_pool_mode = pgbouncer_pool_mode
+    params.pgbouncer_pool_size = pgbouncer_pool_size
+    params.pgbouncer_max_client_conn = pgbouncer_max_client_conn
+    params.databases = databases
+    params.database_user = database_user
+    params.database_pass = database_pass
+    params.pool = pool
 
     postgres_docker = PostgresDockerAction(actions, state)
-    postgres_docker.run_actions()
+    graph = get_action_graph(click_context)
+    if graph is not None:
+        postgres_docker.schedule(graph)
+    else:
+        postgres_docker.run_actions()
+
+
+# what moves with a container between a pool member's work dir and the work dir that claims it
+HANDOFF_FIELDS = ['container_uuid', 'container_name', 'volume_path', 'docker_tag', 'docker_uid', 'docker_auto_remove',
+                  'dbs_type', 'dbs_user', 'dbs_pass', 'dbs_host', 'dbs_port', 'dbs_port_preferred', 'dbs_status',
+                  'dbs_ready_seconds', 'dbs_profile', 'dbs_settings', 'dbs_initial_databases', 'users', 'databases']
+
+
+def pool_config(source) -> t.Dict[str, t.Any]:
+    """The settings a claimed container has to match, from params or a state."""
+    return {'docker_tag': source.docker_tag, 'dbs_user': source.dbs_user, 'dbs_pass': source.dbs_pass,
+            'dbs_profile': source.dbs_profile}
+
+
+def postgres_profile_settings(profile: str) -> t.Dict[str, str]:
+    if profile == 'ephemeral':
+        return {'fsync': 'off', 'synchronous_commit': 'off', 'full_page_writes': 'off'}
+    if profile == 'throughput':
+        # along the lines of pgtune's recommendations for a dedicated server
+        cpus = os.cpu_count() or 1
+        memory_mb = (setupservers.host_memory_bytes() or 4 * 1024 ** 3) // 1024 ** 2
+        max_connections = 200
+        shared_buffers_mb = memory_mb // 4
+        return {
+            'max_connections': str(max_connections),
+            'shared_buffers': f'{shared_buffers_mb}MB',
+            'effective_cache_size': f'{memory_mb * 3 // 4}MB',
+            'work_mem': f'{max((memory_mb - shared_buffers_mb) // (max_connections * 3), 4)}MB',
+            'maintenance_work_mem': f'{min(memory_mb // 16, 2048)}MB',
+            'wal_buffers': '16MB',
+            'min_wal_size': '1GB',
+            'max_wal_size': '4GB',
+            'checkpoint_completion_target': '0.9',
+            'max_worker_processes': str(cpus),
+            'max_parallel_workers': str(cpus),
+            'max_parallel_workers_per_gather': str(min(max(cpus // 2, 1), 4)),
+        }
+    return {}
 
 
 class PostgresDockerAction(Action[PostgresDockerState]):
@@ -109,24 +251,52 @@ class PostgresDockerAction(Action[PostgresDockerState]):
                  actions: Actions,
                  state: PostgresDockerState):
         super(PostgresDockerAction, self).__init__(actions, state)
-        self.docker_client: docker.DockerClient = docker.from_env()
+        self.docker_client: 'docker.DockerClient' = docker_client()
+        self.port_registry: PortRegistry = PortRegistry()
 
     def run_actions(self):
         # self.checks()
-        for action in self.state.params.actions:
-            if action == 'dbs-start':
-                self.dbs_start()
-            elif action == 'dbs-stop':
-                self.dbs_stop()
-            elif action == 'docker-remove':
-                self.docker_remove()
+        # the actions save as they go, the state file is written once at the end
+        with self.state.batch():
+            for action in self.state.params.actions:
+                if action == 'dbs-start':
+                    self.dbs_start()
+                elif action == 'dbs-stop':
+                    self.dbs_stop()
+                elif action == 'docker-remove':
+                    self.docker_remove()
+                elif action == 'dbs-snapshot':
+                    self.dbs_snapshot()
+                elif action == 'dbs-clone':
+                    self.dbs_clone()
+                elif action == 'db-create':
+                    self.db_create()
+                elif action == 'db-drop':
+                    self.db_drop()
 
+    def schedule(self, graph: ActionGraph):
+        params = self.state.params
+
+        def run_actions():
+            # steps on the same state run in chain order, each with the params it was invoked with
+            self.state.params = params
+            self.run_actions()
+
+        graph.add(f"postgres-docker {self.state.path.name}", run_actions, [self.state.path])
+
+    @traced('dbs-start')
     def dbs_start(self):
-        container: Container = None
+        container: t.Optional['Container'] = None
         if self.state.container_uuid:
+            with span('container start'):
+                container = self.docker_client.containers.get(self.state.container_uuid)
+                container.start()
+            if self.state.dbs_profile and self.state.dbs_profile != self.state.params.dbs_profile:
+                self.logger.warning(f"Container was created with the {self.state.dbs_profile} profile, remove it "
+                                    f"to switch to {self.state.params.dbs_profile}.")
+        # without a container, a recorded profile comes from dbs-clone and the cloned data is started instead
+        elif self.state.params.pool and not self.state.dbs_profile and self._pool_claim():
             container = self.docker_client.containers.get(self.state.container_uuid)
-            container.start()
-            attrs = container.attrs
         else:
             self.state.docker_tag = self.state.docker_tag or self.state.params.docker_tag
 
@@ -140,68 +310,455 @@ class PostgresDockerAction(Action[PostgresDockerState]):
 
             self.state.dbs_host = self.state.dbs_host or self.state.params.dbs_host
             self.state.dbs_port_preferred = self.state.dbs_port_preferred or self.state.params.dbs_port
-            self.state.dbs_port = setupservers.find_free_port(self.state.dbs_host, self.state.dbs_port_preferred)
+            self.state.dbs_port = self.port_registry.allocate(
+                self.state.path, {'dbs': (self.state.dbs_host, self.state.dbs_port_preferred)})['dbs']
+
+            if self.state.dbs_profile and self.state.dbs_profile != self.state.params.dbs_profile:
+                self.logger.warning(f"The data directory was cloned from a {self.state.dbs_profile} snapshot, "
+                                    f"the container uses that profile instead of {self.state.params.dbs_profile}.")
+            # a cloned data directory keeps the profile of its snapshot
+            self.state.dbs_profile = self.state.dbs_profile or self.state.params.dbs_profile or 'durable'
+            self.state.dbs_settings = postgres_profile_settings(self.state.dbs_profile)
+            command = ['postgres']
+            for name, value in self.state.dbs_settings.items():
+                command.extend(['-c', f'{name}={value}'])
+
+            volumes = {}
+            tmpfs = {}
+            shm_size = None
+            if self.state.dbs_profile == 'ephemeral':
+                # world writable so the container's non-root user can create PGDATA
+                tmpfs = {'/var/lib/postgresql/data': 'rw,mode=1777'}
+                # a docker-volume left by an earlier container is not this container's data
+                self.state.volume_path = None
+            else:
+                self.state.volume_path = self.state.path / 'docker-volume'
+                self.state.volume_path.mkdir(parents=True, exist_ok=True)
+                volumes = {str(self.state.volume_path): {'bind': '/var/lib/postgresql/data', 'mode': 'rw'}}
+            if self.state.dbs_profile == 'throughput':
+                # parallel query workers use dynamic shared memory, the Docker default of 64m is too small
+                shm_size = '1g'
 
-            self.state.volume_path = self.state.path / 'docker-volume'
-            self.state.volume_path.mkdir(parents=True, exist_ok=True)
-            volumes = {str(self.state.volume_path): {'bind': '/var/lib/postgresql/data', 'mode': 'rw'}}
             environment = {'PGDATA': '/var/lib/postgresql/data/pgdata',
                            'POSTGRES_USER': self.state.dbs_user,
                            'POSTGRES_PASSWORD': self.state.dbs_pass}
             ports = {5432: int(self.state.dbs_port)}
 
-            container = self.docker_client.containers.run(
-                "postgres:" + self.state.docker_tag,
-                user=self.state.docker_uid,
-                name=self.state.container_name,
-                remove=self.state.params.docker_auto_remove,
-                detach=True,
-                volumes=volumes,
-                environment=environment,
-                ports=ports
-            )
+            with span('container create', image=f'postgres:{self.state.docker_tag}'):
+                container = self.docker_client.containers.run(
+                    "postgres:" + self.state.docker_tag,
+                    command=command,
+                    user=self.state.docker_uid,
+                    name=self.state.container_name,
+                    remove=self.state.params.docker_auto_remove,
+                    detach=True,
+                    volumes=volumes,
+                    tmpfs=tmpfs,
+                    shm_size=shm_size,
+                    environment=environment,
+                    ports=ports
+                )
             self.state.container_uuid = container.id
+            self.state.docker_auto_remove = self.state.params.docker_auto_remove
+            self.port_registry.update(self.state.path, container=container.id)
 
-        for i in range(10):
-            container.reload()
-            if container.status == 'running':
-                break
-            time.sleep(i)
+        if self.state.params.ready_timeout:
+            with span('dbs readiness'):
+                self.state.dbs_ready_seconds = setupservers.wait_until(
+                    lambda: setupservers.is_postgres_ready(self.state.dbs_host, self.state.dbs_port,
+                                                           self.state.dbs_user),
+                    timeout=self.state.params.ready_timeout)
+            self.logger.info(f"PostgreSQL accepting connections after {self.state.dbs_ready_seconds:.1f}s")
 
+        container.reload()
         self.state.dbs_status = container.status
         self.state.dbs_type = 'postgres'
+        if self.state.params.pgbouncer:
+            self._pooler_start(container)
+        else:
+            self._pooler_remove()
         self.state.save()
         self.logger.info(f"Started PostgreSQL on {self.state.dbs_host}:{self.state.dbs_port} from directory: {self.state.path}.")
-        self.logger.info(f"Docker UUID: {self.state.container_uuid}")
+        self.logger.info(f"Docker UUID: {self.state.container_uuid}, profile: {self.state.dbs_profile}")
 
+    @traced('dbs-stop')
     def dbs_stop(self):
+        # a claimed container goes back to the pool it came from, whether or not --pool is given again
+        if self.state.container_uuid and self.state.pool_name and self._pool_return():
+            self.state.save()
+            return
         if self.state.container_uuid:
-            container: Container = self.docker_client.containers.get(self.state.container_uuid)
-            auto_remove = container.attrs['HostConfig']['AutoRemove']
-            container.stop()
+            auto_remove = self.state.docker_auto_remove
+            if auto_remove is None:
+                # state saved before the flag was recorded
+                auto_remove = self.docker_client.api.inspect_container(
+                    self.state.container_uuid)['HostConfig']['AutoRemove']
+            self._pooler_remove()
+            self._forget_databases()
+            # the low level API works from the id, no need to inspect the container first
+            self.docker_client.api.stop(self.state.container_uuid)
             if auto_remove:
                 self.state._clear()
+                self.port_registry.release(self.state.path)
             else:
-                for i in range(10):
-                    container.reload()
-                    if container.status == 'exited':
-                        break
-                    time.sleep(i)
-                self.state.dbs_status = container.status
+                # blocks on the Docker API until the container is no longer running
+                self.docker_client.api.wait(self.state.container_uuid, condition='not-running')
+                self.state.dbs_status = 'exited'
             self.logger.info(f"Stopped PostgreSQL on {self.state.dbs_host}:{self.state.dbs_port} from directory: {self.state.path}")
         else:
             self.logger.info(f"PostgreSQL already stopped from directory: {self.state.path}")
         self.state.save()
 
+    @traced('docker-remove')
     def docker_remove(self):
         if self.state.container_uuid:
-            container: Container = self.docker_client.containers.get(self.state.container_uuid)
-            container.stop()
-            container.remove()
+            users = StateIndex().find(type='fhir', status='running', dbs_work_dir=self.state.path)
+            for work_dir in users:
+                self.logger.warning(f"HAPI in {work_dir} is running against this database.")
+            self._pooler_remove()
+            self.docker_client.api.stop(self.state.container_uuid)
+            self.docker_client.api.remove_container(self.state.container_uuid)
             self.logger.info(f"Removing PostgreSQL Docker container id: {self.state.container_uuid}")
+            self._forget_databases()
             self.state._clear()
+            self.port_registry.release(self.state.path)
             self.state.save()
 
+    @traced('pgbouncer start')
+    def _pooler_start(self, container: 'Container'):
+        """A new PgBouncer container for every start, it holds no data and the PostgreSQL container's address can
+        change when it restarts."""
+        self._pooler_remove()
+        params = self.state.params
+        ports = self.port_registry.allocate(self.state.path, {'pooler': (self.state.dbs_host, params.pgbouncer_port)})
+        port = ports['pooler']
+        environment = {
+            # the containers share the default bridge network, where names don't resolve
+            'DB_HOST': container.attrs['NetworkSettings']['IPAddress'],
+            'DB_PORT': '5432',
+            'DB_USER': self.state.dbs_user,
+            'DB_PASSWORD': self.state.dbs_pass,
+            # the password is kept in plain text, which lets PgBouncer answer both SCRAM and md5 servers
+            'AUTH_TYPE': 'scram-sha-256',
+            # the roles of db-create are looked up in the server through this superuser
+            'AUTH_USER': self.state.dbs_user,
+            'LISTEN_PORT': '5432',
+            'POOL_MODE': params.pgbouncer_pool_mode,
+            'DEFAULT_POOL_SIZE': str(params.pgbouncer_pool_size),
+            'MAX_CLIENT_CONN': str(params.pgbouncer_max_client_conn),
+        }
+        name = f'{self.state.container_name}-pgbouncer'
+        from docker.errors import NotFound
+        try:
+            # left over when the state lost track of it
+            self.docker_client.api.remove_container(name, force=True)
+        except NotFound:
+            pass
+        with span('container create', image=params.pgbouncer_tag):
+            pooler = self.docker_client.containers.run(
+                params.pgbouncer_tag,
+                name=name,
+                detach=True,
+                environment=environment,
+                ports={5432: port}
+            )
+        self.state.pooler_container_uuid = pooler.id
+        self.state.pooler_host = self.state.dbs_host
+        self.state.pooler_port = port
+        self.state.pooler_mode = params.pgbouncer_pool_mode
+        # the pooler lease lives as long as the database container
+        self.port_registry.update(self.state.path, container=self.state.container_uuid)
+
+        if params.ready_timeout:
+            setupservers.wait_until(
+                lambda: setupservers.is_postgres_ready(self.state.pooler_host, port, self.state.dbs_user),
+                timeout=params.ready_timeout)
+        self.logger.info(f"PgBouncer ({self.state.pooler_mode} pooling) on {self.state.pooler_host}:{port}")
+
+    def _pooler_remove(self):
+        if not self.state.pooler_container_uuid:
+            return
+        from docker.errors import NotFound
+        try:
+            self.docker_client.api.remove_container(self.state.pooler_container_uuid, force=True)
+        except NotFound:
+            pass
+        self.port_registry.release(self.state.path, names=['pooler'])
+        self.logger.info(f"Removed PgBouncer container id: {self.state.pooler_container_uuid}")
+        self.state.pooler_container_uuid = None
+        self.state.pooler_host = None
+        self.state.pooler_port = None
+        self.state.pooler_mode = None
+
+    @traced('db-create')
+    def db_create(self):
+        """Create the --database databases, each owned by a login role, in the running server. Existing ones are
+        recorded in the state as they are."""
+        params = self.state.params
+        if not params.databases:
+            raise Exception('db-create needs --database.')
+        self._require_running()
+        for name in params.databases:
+            owner = self._db_user(params.database_user or name)
+            if self._psql(f"SELECT 1 FROM pg_database WHERE datname = {_literal(name)}"):
+                if name not in self.state.databases:
+                    self._psql(f"ALTER DATABASE {_identifier(name)} OWNER TO {_identifier(owner.name)}")
+            else:
+                # CREATE DATABASE can't run in a transaction block, so one statement per psql call
+                self._psql(f"CREATE DATABASE {_identifier(name)} OWNER {_identifier(owner.name)}")
+            self.state.databases[name] = DBDatabase(name, owner.name)
+            self.logger.info(f"PostgreSQL database {name} owned by {owner.name} in {self.state.path}")
+        self.state.save()
+
+    @traced('db-drop')
+    def db_drop(self):
+        params = self.state.params
+        if not params.databases:
+            raise Exception('db-drop needs --database.')
+        self._require_running()
+        for name in params.databases:
+            clients = StateIndex().find(type='fhir', status='running', dbs_work_dir=self.state.path,
+                                        dbs_database=name)
+            if clients and not params.unsafe:
+                raise Exception(f"HAPI in {', '.join(str(path) for path in clients)} is running against database "
+                                f"{name}, stop it first or use --unsafe.")
+            self._psql(f"SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = {_literal(name)}")
+            self._psql(f"DROP DATABASE IF EXISTS {_identifier(name)}")
+            database = self.state.databases.pop(name, None)
+            self.logger.info(f"Dropped PostgreSQL database {name} from {self.state.path}")
+
+            owner = database.owner if database is not None else None
+            if owner and owner != self.state.dbs_user and \
+                    not any(other.owner == owner for other in self.state.databases.values()):
+                self._psql(f"DROP ROLE IF EXISTS {_identifier(owner)}")
+                self.state.users.pop(owner, None)
+                self.logger.info(f"Dropped PostgreSQL role {owner}")
+        self.state.save()
+
+    def _db_user(self, name: str) -> DBUser:
+        """The login role, created when it doesn't exist and given --database-pass when that is set."""
+        if name == self.state.dbs_user:
+            # the superuser of the container, its password is set by the image
+            return self.state.users.setdefault(name, DBUser(name, self.state.dbs_pass))
+        user = self.state.users.get(name)
+        password = self.state.params.database_pass
+        if user is not None and (password is None or password == user.password):
+            return user
+        password = password or secrets.token_urlsafe(18)
+        exists = self._psql(f"SELECT 1 FROM pg_roles WHERE rolname = {_literal(name)}")
+        verb = 'ALTER' if exists else 'CREATE'
+        self._psql(f"{verb} ROLE {_identifier(name)} LOGIN PASSWORD {_literal(password)}")
+        user = self.state.users[name] = DBUser(name, password)
+        return user
+
+    def _psql(self, sql: str, database: str = 'postgres') -> str:
+        """Run one statement with psql inside the container, as the superuser over the local socket."""
+        container = self.docker_client.containers.get(self.state.container_uuid)
+        exit_code, output = container.exec_run(
+            ['psql', '-U', self.state.dbs_user, '-d', database, '-v', 'ON_ERROR_STOP=1', '-tA', '-c', sql])
+        output = output.decode('utf-8', errors='replace').strip()
+        if exit_code != 0:
+            raise Exception(f'psql failed with exit code {exit_code}: {output}')
+        return output
+
+    def _record_initial_databases(self):
+        self.state.dbs_initial_databases = self._psql("SELECT datname FROM pg_database WHERE NOT datistemplate",
+                                                      database='template1').splitlines()
+
+    def _require_running(self):
+        if not self.state.container_uuid or self.state.dbs_status != 'running':
+            raise Exception(f'PostgreSQL is not running in {self.state.path}, start it with dbs-start first.')
+
+    def _forget_databases(self):
+        """The databases and roles of the ephemeral profile go with the container's tmpfs."""
+        if self.state.dbs_profile == 'ephemeral':
+            self.state.databases = {}
+            self.state.users = {}
+
+    def _pool_claim(self) -> bool:
+        """Take over a running idle container of the --pool warm pool and start a refill. False when there is none
+        matching the params."""
+        pool = PostgresPool(self.state.params.pool)
+        config = pool_config(self.state.params)
+        pool_state = pool.read()
+        if pool_state['config'] is None:
+            self.logger.warning(f"Pool {pool.name} is not set up, creating a container. Set it up with "
+                                f"postgres-pool --pool {pool.name} --action pool-fill.")
+            return False
+        if pool_state['config'] != config:
+            differences = ', '.join(f"{name} {value}" for name, value in pool_state['config'].items()
+                                    if name != 'dbs_pass' and config.get(name) != value)
+            self.logger.warning(f"Pool {pool.name} holds containers with {differences or 'another password'}, "
+                                f"creating a container.")
+            return False
+
+        with span('pool claim', pool=pool.name):
+            while True:
+                member = pool.claim(config)
+                if member is None:
+                    self.logger.info(f"No idle PostgreSQL container in pool {pool.name}, creating one.")
+                    return False
+                member_state = self.actions.get_action_state(member, PostgresDockerState)
+                container_uuid = member_state.container_uuid
+                if container_uuid and container_statuses([container_uuid]).get(container_uuid) == 'running':
+                    break
+                self.logger.warning(f"Discarding pool member {member}, its container is gone or not running.")
+                self._pool_discard(member_state)
+                pool.forget(member)
+            self._handoff(member_state, self.state)
+            pool.forget(member)
+        pool.refill_in_background()
+        self.state.pool_name = pool.name
+        self.logger.info(f"Claimed PostgreSQL container {self.state.container_uuid} from pool {pool.name}")
+        return True
+
+    @traced('pool return')
+    def _pool_return(self) -> bool:
+        """Reset the claimed container and hand it back to its pool. False when the pool is full or now creates
+        other containers, the container is then stopped as usual."""
+        pool = PostgresPool(self.state.pool_name)
+        pool_state = pool.read()
+        if pool_state['config'] != pool_config(self.state) or len(pool_state['idle']) >= pool_state['size']:
+            return False
+        clients = StateIndex().find(type='fhir', status='running', dbs_work_dir=self.state.path)
+        if clients:
+            message = (f"HAPI in {', '.join(str(path) for path in clients)} is running against this database, "
+                       f"returning it to pool {pool.name} drops all its databases.")
+            if not self.state.params.unsafe:
+                raise Exception(f'{message} Stop it first or use --unsafe.')
+            self.logger.warning(message)
+        self._pooler_remove()
+        self._reset_server()
+
+        member = pool.new_member_path()
+        member_state = self.actions.get_action_state(member, PostgresDockerState)
+        self._handoff(self.state, member_state)
+        member_state.save()
+        if not pool.add_idle(member):
+            # filled up in the meantime
+            self._handoff(member_state, self.state)
+            pool.forget(member)
+            return False
+        self.logger.info(f"Returned PostgreSQL container {self.state.container_uuid} to pool {pool.name}")
+        self.state._clear()
+        return True
+
+    def _pool_discard(self, member_state: PostgresDockerState):
+        from docker.errors import NotFound
+        if member_state.container_uuid:
+            try:
+                self.docker_client.api.remove_container(member_state.container_uuid, force=True)
+            except NotFound:
+                pass
+        self.port_registry.release(member_state.path)
+
+    def _handoff(self, source: PostgresDockerState, target: PostgresDockerState):
+        for name in HANDOFF_FIELDS:
+            setattr(target, name, getattr(source, name))
+        self.port_registry.transfer(source.path, target.path)
+
+    def _reset_server(self):
+        """Back to a freshly initialized server: the client sessions are ended, the databases initdb created are
+        recreated empty, the others dropped, and the roles besides the superuser are dropped."""
+        self._psql("SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+                   "WHERE pid <> pg_backend_pid() AND backend_type = 'client backend'", database='template1')
+        for name in self._psql("SELECT datname FROM pg_database WHERE NOT datistemplate",
+                               database='template1').splitlines():
+            self._psql(f"DROP DATABASE {_identifier(name)}", database='template1')
+        # the image creates POSTGRES_DB, named after the superuser, besides postgres
+        initial = self.state.dbs_initial_databases or sorted({'postgres', self.state.dbs_user})
+        for name in initial:
+            self._psql(f"CREATE DATABASE {_identifier(name)}", database='template1')
+        for name in self._psql("SELECT rolname FROM pg_roles WHERE rolname !~ '^pg_' AND rolname <> current_user",
+                               database='template1').splitlines():
+            self._psql(f"DROP ROLE {_identifier(name)}", database='template1')
+        self.state.databases = {}
+        self.state.users = {}
+
+    @traced('dbs-snapshot')
+    def dbs_snapshot(self):
+        """Store the data directory of the stopped server in the snapshot cache, addressed by its content."""
+        if self.state.dbs_profile == 'ephemeral':
+            raise Exception('The ephemeral profile keeps the data on tmpfs, there is no data directory to snapshot.')
+        if self.state.volume_path is None or not self.state.volume_path.exists():
+            raise Exception(f'No data directory to snapshot in {self.state.path}.')
+        if self.state.container_uuid and \
+                self.docker_client.api.inspect_container(self.state.container_uuid)['State']['Running']:
+            raise Exception('PostgreSQL is running, stop it (dbs-stop) before taking a snapshot.')
+
+        cache = DirectoryCache('pg-snapshots', max_entries=self.state.params.snapshot_cache_size)
+        key = setupservers.tree_sha256(self.state.volume_path)
+        metadata = {'docker_tag': self.state.docker_tag, 'dbs_profile': self.state.dbs_profile or 'durable',
+                    'dbs_user': self.state.dbs_user, 'dbs_pass': self.state.dbs_pass, 'source': str(self.state.path),
+                    'users': {name: user.password for name, user in self.state.users.items()},
+                    'databases': {name: database.owner for name, database in self.state.databases.items()}}
+
+        def populate(entry_path: Path):
+            shutil.copytree(self.state.volume_path, entry_path / 'docker-volume', symlinks=True,
+                            copy_function=setupservers.clone_file)
+            with open(entry_path / 'snapshot.yaml', 'w') as f:
+                yaml.safe_dump(metadata, f)
+
+        with cache.lock(key):
+            if cache.get(key) is None:
+                cache.put(key, populate)
+        if self.state.params.snapshot:
+            (cache.path / f'{self.state.params.snapshot}.name').write_text(key)
+
+        self.state.dbs_snapshot = key
+        self.state.save()
+        self.logger.info(f"PostgreSQL snapshot {self.state.params.snapshot or ''} {key} taken from {self.state.path}")
+
+    @traced('dbs-clone')
+    def dbs_clone(self):
+        """Copy a snapshot into this work dir's data directory, as reflinks where the file system supports them. Hardlinks
+        are not an option since PostgreSQL updates its files in place.
+        """
+        if not self.state.params.snapshot:
+            raise Exception('dbs-clone needs --snapshot.')
+        if self.state.container_uuid:
+            raise Exception('A container already exists for this work dir, remove it (docker-remove) before cloning.')
+        if self.state.params.dbs_profile == 'ephemeral':
+            raise Exception('The ephemeral profile keeps the data on tmpfs, clone the snapshot for a profile using '
+                            'the docker-volume directory.')
+
+        cache = DirectoryCache('pg-snapshots', max_entries=self.state.params.snapshot_cache_size)
+        key = self.state.params.snapshot
+        name_path = cache.path / f'{key}.name'
+        if name_path.exists():
+            key = name_path.read_text().strip()
+        entry = cache.get(key)
+        if entry is None:
+            raise Exception(f'No PostgreSQL snapshot {self.state.params.snapshot} in {cache.path}.')
+
+        volume_path = self.state.path / 'docker-volume'
+        if volume_path.exists() and any(volume_path.iterdir()):
+            if not self.state.params.unsafe:
+                raise Exception(f'{volume_path} is not empty, use --unsafe to replace it with the snapshot.')
+            shutil.rmtree(volume_path)
+        elif volume_path.exists():
+            volume_path.rmdir()
+
+        with cache.lock(key):
+            shutil.copytree(entry / 'docker-volume', volume_path, symlinks=True,
+                            copy_function=setupservers.clone_file)
+        with open(entry / 'snapshot.yaml') as f:
+            metadata = yaml.safe_load(f)
+
+        # the roles and the on-disk format come with the data
+        self.state.volume_path = volume_path
+        self.state.docker_tag = metadata['docker_tag']
+        # snapshots taken before the profile was recorded are from the durable profile
+        self.state.dbs_profile = metadata.get('dbs_profile') or 'durable'
+        self.state.dbs_user = metadata['dbs_user']
+        self.state.dbs_pass = metadata['dbs_pass']
+        self.state.users = {name: DBUser(name, password) for name, password in metadata.get('users', {}).items()}
+        self.state.databases = {name: DBDatabase(name, owner)
+                                for name, owner in metadata.get('databases', {}).items()}
+        self.state.dbs_snapshot = key
+        self.state.save()
+        self.logger.info(f"PostgreSQL snapshot {key} cloned into {self.state.path}")
+
     # def checks(self):
     #     if self.empty_state and self.volume_path.exists():
     #         # something went wrong and the state wasn't updated
@@ -288,3 +845,11 @@ class PostgresDockerAction(Action[PostgresDockerState]):
     #
     #     self.state.save()
     #     return self.docker_client.containers.get(self.state.container_uuid)
+
+
+def _identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
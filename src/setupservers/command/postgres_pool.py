@@ -0,0 +1,109 @@
+import json
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import click
+from clickactions import Actions, Command
+
+from setupservers.command.postgres_docker import PostgresDockerAction, PostgresDockerParams, PostgresDockerState
+from setupservers.pg_pool import PostgresPool, DEFAULT_POOL_SIZE
+
+
+@click.command(name='postgres-pool', cls=Command)
+@click.option('--pool', default='default', help='The name of the pool, postgres-docker --pool claims from it.')
+@click.option('--size', type=int, help=f'Idle containers to keep. Defaults to the size set before, or '
+                                       f'{DEFAULT_POOL_SIZE}.')
+@click.option('--docker-tag', help="Defaults to the pool's tag, or latest.")
+@click.option('--dbs-user', help="Defaults to the pool's user, or postgres.")
+@click.option('--dbs-pass', help="Defaults to the pool's password, or postgres.")
+@click.option('--dbs-port', type=int, default=5432, help='Preferred port of the first container.')
+@click.option('--ready-timeout', type=int, default=60,
+              help='Seconds to wait for a new container to accept connections before it is idle.')
+@click.option('--action', multiple=True, type=click.Choice(['pool-fill', 'pool-drain', 'pool-status']),
+              help='pool-fill: create containers until --size are idle, after removing idle ones created with other '
+                   'settings. pool-drain: remove the idle containers. pool-status: print the pool as JSON.')
+@click.pass_context
+def command(ctx: click.Context, pool, size, docker_tag, dbs_user, dbs_pass, dbs_port, ready_timeout, action):
+    """Keep idle, initialized PostgreSQL containers running for postgres-docker --pool to claim."""
+    actions: Actions = ctx.obj
+    postgres_pool = PostgresPool(pool)
+    for pool_action in action:
+        if pool_action == 'pool-fill':
+            pool_state = postgres_pool.read()
+            config = pool_state['config'] or {}
+            config = {'docker_tag': docker_tag or config.get('docker_tag') or 'latest',
+                      'dbs_user': dbs_user or config.get('dbs_user') or 'postgres',
+                      'dbs_pass': dbs_pass or config.get('dbs_pass') or 'postgres',
+                      # the data directory is on tmpfs, so nothing has to move with a claimed container
+                      'dbs_profile': 'ephemeral'}
+            _fill(actions, postgres_pool, size or pool_state['size'], config, dbs_port, ready_timeout)
+        elif pool_action == 'pool-drain':
+            with postgres_pool.fill_lock:
+                idle = postgres_pool.take_idle()
+                for member in idle:
+                    _remove_member(actions, postgres_pool, member)
+            actions.logger.info(f"Removed {len(idle)} idle PostgreSQL containers from pool {pool}")
+        elif pool_action == 'pool-status':
+            pool_state = postgres_pool.read()
+            members = []
+            for member in pool_state['idle']:
+                state = actions.get_action_state(member, PostgresDockerState)
+                members.append({'work_dir': member, 'port': state.dbs_port, 'container': state.container_uuid})
+            click.echo(json.dumps({'pool': pool, 'path': str(postgres_pool.path), 'size': pool_state['size'],
+                                   'config': pool_state['config'], 'idle': members}, indent=2))
+
+
+def _fill(actions: Actions, postgres_pool: PostgresPool, size: int, config: t.Dict[str, t.Any], dbs_port: int,
+          ready_timeout: int):
+    # refills started by concurrent claims wait here and then find the pool full
+    with postgres_pool.fill_lock:
+        for member in postgres_pool.configure(size, config):
+            _remove_member(actions, postgres_pool, member)
+        pool_state = postgres_pool.read()
+        missing = pool_state['size'] - len(pool_state['idle'])
+        if missing <= 0:
+            actions.logger.info(f"Pool {postgres_pool.name} has {len(pool_state['idle'])} idle PostgreSQL containers")
+            return
+        with ThreadPoolExecutor(missing) as executor:
+            added = list(executor.map(
+                lambda _: _create_member(actions, postgres_pool, config, dbs_port, ready_timeout), range(missing)))
+        actions.logger.info(f"Added {sum(added)} idle PostgreSQL containers to pool {postgres_pool.name}")
+
+
+def _create_member(actions: Actions, postgres_pool: PostgresPool, config: t.Dict[str, t.Any], dbs_port: int,
+                   ready_timeout: int) -> bool:
+    member = postgres_pool.new_member_path()
+    state: PostgresDockerState = actions.get_action_state(member, PostgresDockerState)
+    params = state.params = PostgresDockerParams()
+    params.docker_tag = config['docker_tag']
+    params.dbs_user = config['dbs_user']
+    params.dbs_pass = config['dbs_pass']
+    params.dbs_host = 'localhost'
+    params.dbs_port = dbs_port
+    # initdb runs when the container is created, claims get a server that accepts connections
+    params.ready_timeout = ready_timeout
+    params.dbs_profile = config['dbs_profile']
+    try:
+        with state.batch():
+            action = PostgresDockerAction(actions, state)
+            action.dbs_start()
+            if ready_timeout:
+                # what a returned container is reset to, psql can only connect once initdb is done
+                action._record_initial_databases()
+    except Exception:
+        actions.logger.exception(f"Could not create a PostgreSQL container for pool {postgres_pool.name}")
+        _remove_member(actions, postgres_pool, member)
+        return False
+    if not postgres_pool.add_idle(member):
+        _remove_member(actions, postgres_pool, member)
+        return False
+    return True
+
+
+def _remove_member(actions: Actions, postgres_pool: PostgresPool, member: Path):
+    state: PostgresDockerState = actions.get_action_state(member, PostgresDockerState)
+    if state.container_uuid:
+        with state.batch():
+            PostgresDockerAction(actions, state).docker_remove()
+    postgres_pool.forget(member)
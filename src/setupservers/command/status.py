@@ -0,0 +1,144 @@
+import json
+import os
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import click
+from clickactions import Command, Actions, ActionState
+
+import setupservers
+from setupservers import FhirServerState
+from setupservers.state_index import StateIndex, index_entry
+
+# directories inside a work dir that never hold another work dir
+SKIP_DIRS = {'.git', '.m2', 'logs', 'docker-volume', 'hapi-run', 'hapi-jpa-starter', 'apache-maven-3.8.6'}
+
+
+@click.command(name='status', cls=Command)
+@click.option('--work-dir', help='Where to look for work dirs. Defaults to the project directory.')
+@click.option('--probe', is_flag=True, help='Also check that each running HAPI answers on fhir_url/metadata.')
+@click.option('--repair/--no-repair', default=True, help='Correct recorded status, pid and container fields that '
+                                                         'no longer match what is running.')
+@click.option('--scan', is_flag=True, help='Find the work dirs by walking the directory tree instead of reading the '
+                                           'state index, and rebuild the index entries under it.')
+@click.option('--json', 'as_json', is_flag=True, help='Print JSON instead of a table.')
+@click.option('--workers', type=int, default=16)
+@click.pass_context
+def command(ctx: click.Context, work_dir, probe, repair, scan, as_json, workers):
+    actions: Actions = ctx.obj
+    root = (actions.actions_home_path / work_dir) if work_dir else actions.actions_home_path
+    root = root.resolve()
+    exclude = actions.actions_home_path.resolve()
+
+    index = StateIndex()
+    work_dirs = None if scan else indexed_work_dirs(index, root, exclude)
+    if not work_dirs:
+        # nothing indexed yet, e.g. work dirs created before the index existed
+        scan = True
+        work_dirs = find_work_dirs(root, exclude=exclude)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        states: t.List[ActionState] = list(pool.map(ActionState, work_dirs))
+        if scan:
+            index.replace(root, {state.path: index_entry(state) for state in states})
+
+        container_ids = [getattr(state, 'container_uuid', None) for state in states]
+        container_statuses = {}
+        if any(container_ids):
+            from setupservers.docker_client import container_statuses as docker_statuses
+            container_statuses = docker_statuses(container_ids)
+
+        rows = [_status_row(state, root, container_statuses) for state in states]
+        if probe:
+            urls = [row['fhir_url'] if row['live'] == 'running' and row.get('fhir_url') else None for row in rows]
+            probes = pool.map(lambda url: setupservers.is_http_ready(url + '/metadata') if url else None, urls)
+            for row, ready in zip(rows, probes):
+                if ready is not None:
+                    row['ready'] = ready
+
+    if repair:
+        for state, row in zip(states, rows):
+            _repair(actions, state, row)
+
+    if as_json:
+        click.echo(json.dumps(rows, indent=2))
+    else:
+        click.echo(_table(rows))
+
+
+def find_work_dirs(root: Path, exclude: t.Optional[Path] = None) -> t.List[Path]:
+    work_dirs = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = sorted(name for name in dir_names if name not in SKIP_DIRS)
+        if str(ActionState.ACTION_STATE_FILE) in file_names and Path(dir_path) != exclude:
+            work_dirs.append(Path(dir_path))
+    return work_dirs
+
+
+def indexed_work_dirs(index: StateIndex, root: Path, exclude: t.Optional[Path] = None) -> t.List[Path]:
+    work_dirs = []
+    for work_dir in sorted(index.entries()):
+        if work_dir == exclude or not (work_dir / ActionState.ACTION_STATE_FILE).exists():
+            continue
+        if work_dir == root or root in work_dir.parents:
+            work_dirs.append(work_dir)
+    return work_dirs
+
+
+def _status_row(state: ActionState, root: Path, container_statuses: t.Dict[str, str]) -> t.Dict[str, t.Any]:
+    row: t.Dict[str, t.Any] = {'work_dir': str(state.path.relative_to(root)) if state.path != root else '.'}
+    if hasattr(state, 'container_uuid'):
+        row['type'] = getattr(state, 'dbs_type', None) or 'postgres'
+        row['status'] = state.dbs_status
+        row['port'] = state.dbs_port
+        row['container'] = state.container_uuid[:12] if state.container_uuid else None
+        if state.container_uuid:
+            row['live'] = container_statuses.get(state.container_uuid, 'missing')
+        else:
+            row['live'] = None
+    elif hasattr(state, 'fhir_url'):
+        row['type'] = 'fhir'
+        row['status'] = state.status
+        row['fhir_url'] = state.fhir_url
+        row['pid'] = state.pid
+        if state.pid is not None:
+            row['live'] = 'running' if setupservers.pid_exists(state.pid) else 'missing'
+        else:
+            row['live'] = None
+    else:
+        row['type'] = None
+        row['status'] = None
+        row['live'] = None
+    return row
+
+
+def _repair(actions: Actions, state: ActionState, row: t.Dict[str, t.Any]):
+    # written through the typed states, which replace the file atomically and update the state index
+    if row['type'] == 'fhir' and row['live'] == 'missing':
+        fhir_state = FhirServerState(state.path)
+        fhir_state.pid = None
+        fhir_state.status = 'stopped'
+        fhir_state.save()
+    elif row['type'] == 'postgres' and row['live'] is not None and row['live'] != row['status']:
+        from setupservers.command.postgres_docker import PostgresDockerAction, PostgresDockerState
+        dbs_state = PostgresDockerState(state.path)
+        if row['live'] == 'missing':
+            # the PgBouncer container outlives a removed PostgreSQL container, its name would block the next start
+            PostgresDockerAction(actions, dbs_state)._pooler_remove()
+            # clears everything that belonged to the container
+            dbs_state._clear()
+        else:
+            dbs_state.dbs_status = row['live']
+        dbs_state.save()
+    else:
+        return
+    actions.logger.info(f"Repaired stale state in {state.path}: recorded {row['status']}, found {row['live']}")
+    row['repaired'] = True
+
+
+def _table(rows: t.List[t.Dict[str, t.Any]]) -> str:
+    columns = ['work_dir', 'type', 'status', 'live', 'port', 'container', 'pid', 'fhir_url', 'ready', 'repaired']
+    columns = [column for column in columns if any(row.get(column) is not None for row in rows)]
+    cells = [columns] + [['' if row.get(column) is None else str(row[column]) for column in columns] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(line, widths)) for line in cells)
@@ -0,0 +1,118 @@
+import hashlib
+import importlib
+import json
+import re
+import sys
+import typing as t
+from collections import defaultdict
+from importlib import metadata
+from pathlib import Path
+
+import click
+import clickactions
+
+from setupservers.util import atomic_write, cache_home
+
+DISTRIBUTION = 'setup-servers'
+# entry point group: regex of the names to use, None for all
+COMMAND_ENTRY_POINTS = {'clickactions.command': '^(py-debug)$', 'setupservers.command': None}
+
+
+class CommandRegistry(object):
+    """
+    The commands of the COMMAND_ENTRY_POINTS groups, cached in the user cache as name: module:attr and help text.
+    Finding them means scanning all entry points and importing every command module, so that only happens when the
+    installed setup-servers distribution changed or an unknown command is asked for. A run imports just the modules of
+    the commands it invokes.
+    """
+
+    def __init__(self, path: t.Optional[Path] = None):
+        # one registry per Python environment
+        environment = hashlib.sha256(sys.prefix.encode('utf-8')).hexdigest()[:16]
+        self.path: Path = path or cache_home() / 'commands' / f'{environment}.json'
+        self._commands: t.Optional[t.Dict[str, t.Dict[str, t.Any]]] = None
+        self._loaded: t.Dict[str, click.Command] = {}
+        self._refreshed = False
+
+    def commands(self) -> t.Dict[str, t.Dict[str, t.Any]]:
+        if self._commands is None:
+            stamp = _distribution_stamp()
+            cached = self._read()
+            if cached is not None and cached.get('stamp') == stamp:
+                self._commands = cached['commands']
+            else:
+                self.refresh(stamp)
+        return self._commands
+
+    def get(self, name: str) -> t.Optional[click.Command]:
+        if name in self._loaded:
+            return self._loaded[name]
+        entry = self.commands().get(name)
+        if entry is None:
+            # e.g. a plugin installed by another distribution
+            if self._refreshed:
+                return None
+            self.refresh()
+            return self._loaded.get(name)
+        module_name, _, attributes = entry['target'].partition(':')
+        try:
+            command = importlib.import_module(module_name)
+            for attribute in attributes.split('.'):
+                command = getattr(command, attribute)
+        except (ImportError, AttributeError):
+            # moved or uninstalled since the registry was written
+            if self._refreshed:
+                raise
+            self.refresh()
+            return self._loaded.get(name)
+        self._loaded[name] = command
+        return command
+
+    def refresh(self, stamp: t.Optional[str] = None):
+        commands = {}
+        name_counts: t.Dict[str, int] = defaultdict(int)
+        for group, name_pattern in COMMAND_ENTRY_POINTS.items():
+            for entry_point in _entry_points(group):
+                if name_pattern is not None and not re.match(name_pattern, entry_point.name):
+                    continue
+                command = entry_point.load()
+                if not isinstance(command, clickactions.Command):
+                    continue
+                # same naming of duplicates as clickactions
+                name = entry_point.name
+                name_counts[name] += 1
+                if name_counts[name] > 1:
+                    name += f'-{name_counts[name]}'
+                self._loaded[name] = command
+                commands[name] = {'target': entry_point.value, 'help': command.short_help or command.help or '',
+                                  'hidden': command.hidden}
+        self._commands = commands
+        self._refreshed = True
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(self.path, json.dumps({'stamp': stamp or _distribution_stamp(), 'commands': commands}))
+
+    def _read(self) -> t.Optional[t.Dict[str, t.Any]]:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+def _distribution_stamp() -> str:
+    try:
+        distribution = metadata.distribution(DISTRIBUTION)
+    except metadata.PackageNotFoundError:
+        return ''
+    # an editable reinstall rewrites the metadata without changing the version
+    metadata_path = getattr(distribution, '_path', None)
+    mtime = metadata_path.stat().st_mtime if metadata_path is not None and metadata_path.exists() else None
+    return f'{distribution.version}:{mtime}'
+
+
+def _entry_points(group: str) -> t.List[metadata.EntryPoint]:
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        return list(entry_points.select(group=group))
+    # Python < 3.10
+    return list(entry_points.get(group, []))
@@ -1,14 +1,63 @@
+import pathlib
+import typing as t
+
 import click
 import clickactions
 
+from setupservers import docker_client, tracing
+from setupservers.command_registry import CommandRegistry
+from setupservers.graph import ActionGraph, ACTION_GRAPH_KEY, get_action_graph
+
 
 class SetupServerCommands(clickactions.Commands):
     def __init__(self, **kwargs):
-        super(SetupServerCommands, self).__init__(command_entry_points={'clickactions.command': '^(py-debug)$',
-                                                                   'setupservers.command': None}, chain=True, **kwargs)
+        # the commands come from the registry, not from scanning the entry points on every run
+        super(SetupServerCommands, self).__init__(chain=True, **kwargs)
+        self.registry: CommandRegistry = CommandRegistry()
+
+    def list_commands(self, ctx: click.Context) -> t.List[str]:
+        return sorted(self.registry.commands())
+
+    def get_command(self, ctx: click.Context, cmd_name: str) -> t.Optional[click.Command]:
+        return self.registry.get(cmd_name)
+
+    def format_commands(self, ctx: click.Context, formatter: click.HelpFormatter):
+        # from the registry's help texts, without importing the command modules
+        commands = [(name, entry) for name, entry in sorted(self.registry.commands().items()) if not entry['hidden']]
+        if not commands:
+            return
+        limit = formatter.width - 6 - max(len(name) for name, _ in commands)
+        rows = [(name, click.utils.make_default_short_help(entry['help'], limit)) for name, entry in commands]
+        with formatter.section('Commands'):
+            formatter.write_dl(rows)
+
+    def invoke(self, ctx: click.Context):
+        try:
+            super(SetupServerCommands, self).invoke(ctx)
+            graph = get_action_graph(ctx)
+            if graph is not None:
+                graph.run(ctx.obj.logger)
+        finally:
+            if ctx.obj is not None:
+                docker_client.log_call_stats(ctx.obj.logger)
+                if ctx.meta.get(tracing.PROFILE_KEY):
+                    tracing.log_profile(ctx.obj.logger)
+            if ctx.meta.get(tracing.CHROME_TRACE_KEY):
+                tracing.export_chrome_trace(ctx.meta[tracing.CHROME_TRACE_KEY])
 
 
 @click.command(cls=SetupServerCommands)
-def commands():
+@click.option('--parallel', is_flag=True,
+              help='Run the chained commands as a dependency graph. Only steps sharing a work directory (including '
+                   'a --dbs-work-dir link) are ordered, everything else runs concurrently.')
+@click.option('--workers', type=int, default=4, help='Worker pool size for --parallel.')
+@click.option('--profile', is_flag=True, help='Print a summary of the traced steps at the end of the run.')
+@click.option('--chrome-trace', type=click.Path(path_type=pathlib.Path),
+              help='Write the traced steps of this run as a Chrome trace (chrome://tracing, Perfetto).')
+@click.pass_context
+def commands(ctx: click.Context, parallel, workers, profile, chrome_trace):
     # print("SetupServersCli running")
-    pass
+    if parallel:
+        ctx.meta[ACTION_GRAPH_KEY] = ActionGraph(workers)
+    ctx.meta[tracing.PROFILE_KEY] = profile
+    ctx.meta[tracing.CHROME_TRACE_KEY] = chrome_trace
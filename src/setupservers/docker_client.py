@@ -0,0 +1,61 @@
+import logging
+import threading
+import typing as t
+from collections import defaultdict
+from urllib.parse import urlparse
+
+if t.TYPE_CHECKING:
+    import docker
+
+_client: t.Optional['docker.DockerClient'] = None
+_client_lock = threading.Lock()
+_logger = logging.getLogger('Actions.DockerClient')
+
+# (method, path) -> [calls, total seconds]
+call_stats: t.Dict[t.Tuple[str, str], t.List[float]] = defaultdict(lambda: [0, 0.0])
+
+
+def docker_client() -> 'docker.DockerClient':
+    """The Docker client shared by all actions in this process. Every API call's latency is logged at debug level and
+    accumulated in call_stats. The docker package is imported on the first call."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            import docker
+            _client = docker.from_env()
+            _client.api.hooks['response'].append(_record_call)
+        return _client
+
+
+def container_statuses(container_ids: t.Iterable[str]) -> t.Dict[str, str]:
+    """The status of many containers in a single list call. Containers that no longer exist are left out. Keys are the
+    full container ids."""
+    container_ids = [container_id for container_id in container_ids if container_id]
+    if not container_ids:
+        return {}
+    containers = docker_client().containers.list(all=True, sparse=True, filters={'id': container_ids})
+    return {container.id: container.status for container in containers}
+
+
+def log_call_stats(logger: logging.Logger):
+    if not call_stats:
+        return
+    calls = sum(int(stats[0]) for stats in call_stats.values())
+    seconds = sum(stats[1] for stats in call_stats.values())
+    logger.info(f"Docker API: {calls} calls in {seconds:.2f}s")
+    for (method, path), (count, total) in sorted(call_stats.items(), key=lambda item: -item[1][1]):
+        logger.debug(f"Docker API: {method} {path}: {int(count)} calls in {total:.2f}s")
+
+
+def _record_call(response, *args, **kwargs):
+    path = urlparse(response.request.url).path
+    # group calls on different containers together
+    parts = path.split('/')
+    if len(parts) > 4 and parts[2] == 'containers':
+        parts[3] = '{id}'
+    key = (response.request.method, '/'.join(parts))
+    elapsed = response.elapsed.total_seconds()
+    stats = call_stats[key]
+    stats[0] += 1
+    stats[1] += elapsed
+    _logger.debug(f"{response.request.method} {path} {response.status_code} {elapsed * 1000:.1f}ms")
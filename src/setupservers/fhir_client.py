@@ -0,0 +1,77 @@
+import asyncio
+import ssl
+import typing as t
+from urllib.parse import SplitResult
+
+
+class FhirConnection(object):
+    """A minimal keep-alive HTTP/1.1 client connection on asyncio streams. Paths are relative to the base URL."""
+
+    def __init__(self, base: SplitResult, timeout: float):
+        self.base: SplitResult = base
+        self.timeout = timeout
+        self.reader: t.Optional[asyncio.StreamReader] = None
+        self.writer: t.Optional[asyncio.StreamWriter] = None
+
+    async def request(self, method: str, path: str, body: t.Optional[bytes] = None) \
+            -> t.Tuple[int, t.Dict[str, str], bytes]:
+        try:
+            return await asyncio.wait_for(self._request(method, path, body), self.timeout)
+        except BaseException:
+            # the connection is in an unknown state, the next request opens a new one
+            self.close()
+            raise
+
+    async def _request(self, method: str, path: str, body: t.Optional[bytes]):
+        if self.writer is None:
+            secure = self.base.scheme == 'https'
+            port = self.base.port or (443 if secure else 80)
+            self.reader, self.writer = await asyncio.open_connection(
+                self.base.hostname, port, ssl=ssl.create_default_context() if secure else None)
+
+        target = f'{self.base.path}/{path}' if path else self.base.path or '/'
+        lines = [f'{method} {target} HTTP/1.1', f'Host: {self.base.netloc}',
+                 'Accept: application/fhir+json', 'Connection: keep-alive']
+        if body is not None:
+            lines.extend(['Content-Type: application/fhir+json', f'Content-Length: {len(body)}'])
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b''))
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by the server.')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = b''
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # trailers end with an empty line
+                    while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                content += (await self.reader.readexactly(size + 2))[:-2]
+        elif 'content-length' in headers:
+            content = await self.reader.readexactly(int(headers['content-length']))
+        elif method == 'HEAD' or status in (204, 304):
+            content = b''
+        else:
+            content = await self.reader.read()
+            headers['connection'] = 'close'
+
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, headers, content
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
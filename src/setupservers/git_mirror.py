@@ -0,0 +1,80 @@
+import logging
+import re
+from pathlib import Path
+
+import git
+from filelock import FileLock
+from git import Repo
+
+from setupservers.cache import DirectoryCache
+from setupservers.tracing import traced, span
+from setupservers.util import cache_home
+
+SHA_PATTERN = re.compile(r'^[0-9a-fA-F]{7,40}$')
+
+
+class GitMirror(object):
+    """
+    One bare mirror per git URL in the user cache. Work dirs get their checkouts as worktrees of the mirror so the
+    objects are fetched once per machine, and nothing is fetched when a requested sha is already present.
+    """
+
+    def __init__(self, url: str, logger: logging.Logger):
+        self.url: str = url
+        self.logger: logging.Logger = logger
+        self.path: Path = cache_home() / 'git' / DirectoryCache.key(url)
+        self.lock: FileLock = FileLock(str(self.path) + '.lock')
+
+    @traced('git checkout')
+    def checkout(self, ref: str, work_tree: Path) -> str:
+        """Check out ref (a branch, tag or sha) detached in work_tree and return the commit sha."""
+        with self.lock:
+            mirror = self._open()
+            try:
+                sha = self._resolve(mirror, ref)
+                if not work_tree.exists():
+                    mirror.git.worktree('prune')
+                    mirror.git.worktree('add', '--detach', str(work_tree), sha)
+            finally:
+                mirror.close()
+
+        repo = Repo(work_tree)
+        try:
+            if not self._has_commit(repo, sha):
+                # a full clone made before the mirror existed
+                repo.git.fetch(str(self.path), sha)
+            repo.head.reference = repo.commit(sha)
+            repo.head.reset(index=True, working_tree=True)
+        finally:
+            repo.close()
+        return sha
+
+    def _open(self) -> Repo:
+        if not self.path.exists():
+            self.logger.info(f"Creating git mirror of {self.url} in {self.path}")
+            return Repo.clone_from(self.url, self.path, mirror=True)
+        return Repo(self.path)
+
+    def _resolve(self, mirror: Repo, ref: str) -> str:
+        if SHA_PATTERN.match(ref) and self._has_commit(mirror, ref):
+            return mirror.commit(ref).hexsha
+        try:
+            with span('git fetch', url=self.url):
+                mirror.git.remote('update', '--prune')
+        except git.GitCommandError as e:
+            # keep working offline when the ref is already known
+            try:
+                sha = mirror.commit(ref).hexsha
+            except (git.BadName, ValueError):
+                raise e
+            self.logger.warning(f"Fetching {self.url} failed, using the local {ref} at {sha}: {e}")
+            return sha
+        return mirror.commit(ref).hexsha
+
+    @staticmethod
+    def _has_commit(repo: Repo, sha: str) -> bool:
+        try:
+            repo.git.cat_file('-e', f'{sha}^{{commit}}')
+            return True
+        except git.GitCommandError:
+            return False
@@ -0,0 +1,84 @@
+import logging
+import time
+import typing as t
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from pathlib import Path
+
+import click
+
+from setupservers.tracing import adopt_span, span
+
+ACTION_GRAPH_KEY = 'setupservers.action_graph'
+
+
+class ActionNode(object):
+    def __init__(self, name: str, fn: t.Callable[[], t.Any], depends_on: t.Set['ActionNode']):
+        self.name: str = name
+        self.fn: t.Callable[[], t.Any] = fn
+        self.depends_on: t.Set[ActionNode] = depends_on
+        self.elapsed: t.Optional[float] = None
+
+
+class ActionGraph(object):
+    """
+    Collects the steps of chained commands and runs them on a worker pool. A step waits only for the earlier steps
+    that touch one of the same work directories, so unrelated steps (e.g. a HAPI build and a Postgres start) overlap.
+    """
+
+    def __init__(self, workers: int = 4):
+        self.workers: int = workers
+        self.nodes: t.List[ActionNode] = []
+        self._last_node: t.Dict[Path, ActionNode] = {}
+
+    def add(self, name: str, fn: t.Callable[[], t.Any], work_dirs: t.Iterable[Path]) -> ActionNode:
+        work_dirs = [Path(work_dir) for work_dir in work_dirs]
+        depends_on = {self._last_node[work_dir] for work_dir in work_dirs if work_dir in self._last_node}
+        node = ActionNode(name, fn, depends_on)
+        for work_dir in work_dirs:
+            self._last_node[work_dir] = node
+        self.nodes.append(node)
+        return node
+
+    def run(self, logger: logging.Logger):
+        pending: t.List[ActionNode] = list(self.nodes)
+        done: t.Set[ActionNode] = set()
+        running: t.Dict[Future, ActionNode] = {}
+        error: t.Optional[BaseException] = None
+        start = time.monotonic()
+
+        # the workers' spans nest in this span, the span stack is per thread
+        with span('action-graph', workers=self.workers, steps=len(self.nodes)) as parent_span:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                while running or (pending and error is None):
+                    if error is None:
+                        for node in [n for n in pending if n.depends_on <= done]:
+                            pending.remove(node)
+                            logger.debug(f"Scheduling: {node.name}")
+                            running[pool.submit(self._run_node, node, parent_span)] = node
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        node = running.pop(future)
+                        if future.exception() is not None:
+                            logger.error(f"Failed: {node.name}: {future.exception()}")
+                            error = error or future.exception()
+                        else:
+                            done.add(node)
+                            logger.info(f"Finished: {node.name} in {node.elapsed:.1f}s")
+
+        if error is not None:
+            raise error
+        logger.info(f"Ran {len(done)} steps in {time.monotonic() - start:.1f}s")
+
+    @staticmethod
+    def _run_node(node: ActionNode, parent_span: t.Dict[str, t.Any]):
+        start = time.monotonic()
+        try:
+            with adopt_span(parent_span):
+                return node.fn()
+        finally:
+            node.elapsed = time.monotonic() - start
+
+
+def get_action_graph(ctx: click.Context) -> t.Optional[ActionGraph]:
+    return ctx.meta.get(ACTION_GRAPH_KEY)
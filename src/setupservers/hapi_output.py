@@ -0,0 +1,80 @@
+"""
+Pumps the console output of a HAPI JVM into a size rotated log file. It runs as its own detached process, started
+with the JVM's output pipe as stdin, so the output is kept after the command that started HAPI exits:
+
+    python -m setupservers.hapi_output <log file> <report file>
+
+The startup time Spring Boot logs and the lines matching known failures are written to the JSON report file.
+"""
+import json
+import re
+import sys
+import typing as t
+from pathlib import Path
+
+from setupservers.process_output import OutputLog
+from setupservers.util import atomic_write
+
+STARTED = re.compile(r'Started \w+ in ([\d.]+) seconds')
+
+# first match wins
+ERROR_SIGNATURES = [
+    ('port-in-use', re.compile(r'Address already in use|Port \d+ was already in use')),
+    ('out-of-memory', re.compile(r'java\.lang\.OutOfMemoryError')),
+    ('database-auth', re.compile(r'password authentication failed|Access denied for user')),
+    ('database-unreachable', re.compile(r'Connection to \S+ refused|Unable to acquire JDBC Connection|'
+                                        r'Communications link failure')),
+    ('startup-failed', re.compile(r'APPLICATION FAILED TO START|Application run failed|'
+                                  r'Error starting ApplicationContext')),
+    ('jvm-error', re.compile(r'Exception in thread "main"|Error: Could not create the Java Virtual Machine|'
+                             r'Error occurred during initialization of VM')),
+]
+MAX_ERRORS = 20
+
+
+class HapiOutputReport(object):
+    def __init__(self, path: Path):
+        self.path: Path = path
+        self.started_seconds: t.Optional[float] = None
+        self.errors: t.List[t.Dict[str, str]] = []
+        self.exited = False
+
+    def on_line(self, line: str):
+        started = STARTED.search(line)
+        if started and self.started_seconds is None:
+            self.started_seconds = float(started.group(1))
+            self.save()
+            return
+        for kind, pattern in ERROR_SIGNATURES:
+            if pattern.search(line):
+                if len(self.errors) < MAX_ERRORS:
+                    self.errors.append({'kind': kind, 'line': line.strip()[:500]})
+                    self.save()
+                return
+
+    def save(self):
+        atomic_write(self.path, json.dumps({'started_seconds': self.started_seconds, 'errors': self.errors,
+                                            'exited': self.exited}))
+
+
+def read_report(path: Path) -> t.Optional[t.Dict[str, t.Any]]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def main(log_path: str, report_path: str):
+    report = HapiOutputReport(Path(report_path))
+    report.save()
+    output = OutputLog(Path(log_path), on_line=report.on_line)
+    try:
+        output.pump(sys.stdin.buffer)
+    finally:
+        report.exited = True
+        report.save()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
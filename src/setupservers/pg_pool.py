@@ -0,0 +1,104 @@
+import shutil
+import subprocess
+import sys
+import typing as t
+import uuid
+from pathlib import Path
+
+import yaml
+from filelock import FileLock
+
+from setupservers.state_index import StateIndex
+from setupservers.util import atomic_write, cache_home
+
+DEFAULT_POOL_SIZE = 2
+
+
+class PostgresPool(object):
+    """
+    The bookkeeping of a warm pool of idle PostgreSQL containers, under cache_home()/pg-pool/<name>. Every member is
+    a postgres-docker work dir in members/. pool.yaml, changed under the pool lock, holds the pool's size, the settings
+    its members are created with and the idle members. Claiming a member takes it off the idle list, so one member
+    is never handed to two work dirs. The containers themselves are managed by PostgresDockerAction.
+    """
+
+    def __init__(self, name: str):
+        self.name: str = name
+        self.path: Path = cache_home() / 'pg-pool' / name
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.lock: FileLock = FileLock(str(self.path / 'pool.lock'))
+        # held while members are created or removed, so only one fill runs per pool
+        self.fill_lock: FileLock = FileLock(str(self.path / 'fill.lock'))
+
+    @property
+    def members_path(self) -> Path:
+        return self.path / 'members'
+
+    def new_member_path(self) -> Path:
+        return self.members_path / uuid.uuid4().hex[:12]
+
+    def read(self) -> t.Dict[str, t.Any]:
+        with self.lock:
+            return self._load()
+
+    def configure(self, size: int, config: t.Dict[str, t.Any]) -> t.List[Path]:
+        """Set the size and member settings. Returns the idle members created with other settings, which are no
+        longer claimable and should be removed."""
+        with self.lock:
+            pool = self._load()
+            stale = [] if pool['config'] == config else pool['idle']
+            pool.update(size=size, config=config, idle=[] if stale else pool['idle'])
+            self._save(pool)
+        return [Path(member) for member in stale]
+
+    def claim(self, config: t.Dict[str, t.Any]) -> t.Optional[Path]:
+        """Take an idle member created with config, None when there is none."""
+        with self.lock:
+            pool = self._load()
+            if not pool['idle'] or pool['config'] != config:
+                return None
+            member = pool['idle'].pop(0)
+            self._save(pool)
+        return Path(member)
+
+    def add_idle(self, member: Path) -> bool:
+        """Make member claimable. False, without adding it, when the pool already has its size of idle members."""
+        with self.lock:
+            pool = self._load()
+            if len(pool['idle']) >= pool['size']:
+                return False
+            pool['idle'].append(str(member))
+            self._save(pool)
+        return True
+
+    def take_idle(self) -> t.List[Path]:
+        """Take all the idle members, for removal."""
+        with self.lock:
+            pool = self._load()
+            idle, pool['idle'] = pool['idle'], []
+            self._save(pool)
+        return [Path(member) for member in idle]
+
+    def forget(self, member: Path):
+        """Delete a member's work dir once its container was handed over or removed."""
+        shutil.rmtree(member, ignore_errors=True)
+        StateIndex().remove(member)
+
+    def refill_in_background(self):
+        """Start postgres-pool pool-fill in a detached process, the caller doesn't wait for the new containers."""
+        subprocess.Popen(
+            [sys.executable, '-c', 'from setupservers.commands import commands; commands()',
+             'postgres-pool', '--pool', self.name, '--action', 'pool-fill'],
+            cwd=self.path, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True)
+
+    def _load(self) -> t.Dict[str, t.Any]:
+        pool = {'size': DEFAULT_POOL_SIZE, 'config': None, 'idle': []}
+        path = self.path / 'pool.yaml'
+        if path.exists():
+            with open(path) as f:
+                pool.update(yaml.safe_load(f) or {})
+        return pool
+
+    def _save(self, pool: t.Dict[str, t.Any]):
+        atomic_write(self.path / 'pool.yaml', yaml.safe_dump(pool))
@@ -0,0 +1,106 @@
+import os
+import socket
+import typing as t
+from contextlib import closing
+from pathlib import Path
+
+import yaml
+from filelock import FileLock
+
+from setupservers.tracing import traced
+from setupservers.util import atomic_write, cache_home, is_port_available, pid_exists
+
+
+class PortRegistry(object):
+    """
+    A machine wide, file locked registry of port leases. A lease ties a port to a work dir and to the process or
+    container using it, so concurrent invocations never hand out the same port. Leases whose process is gone and whose
+    container no longer exists are reclaimed on the next allocation.
+    """
+
+    def __init__(self, path: t.Optional[Path] = None):
+        self.path: Path = path or cache_home() / 'ports.yaml'
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock: FileLock = FileLock(str(self.path) + '.lock')
+
+    @traced('port allocation')
+    def allocate(self, work_dir: Path, requests: t.Dict[str, t.Tuple[str, int]]) -> t.Dict[str, int]:
+        """Lease one port per name in requests, given as name: (host, preferred port). A work dir keeps its previous
+        port for a name when that port is still free.
+        """
+        with self.lock:
+            leases = self._reclaim(self._load())
+            allocated = {}
+            for name, (host, preferred) in requests.items():
+                previous = [lease for lease in leases if lease['work_dir'] == str(work_dir) and lease['name'] == name]
+                for lease in previous:
+                    leases.remove(lease)
+                leased_ports = {lease['port'] for lease in leases} | set(allocated.values())
+
+                candidates = [lease['port'] for lease in previous] + [int(preferred)]
+                port = next((p for p in candidates if p not in leased_ports and is_port_available(host, p)), None)
+                while port is None or port in leased_ports:
+                    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+                        s.bind((host, 0))
+                        port = s.getsockname()[1]
+
+                allocated[name] = port
+                leases.append({'port': port, 'host': host, 'work_dir': str(work_dir), 'name': name,
+                               'pid': os.getpid(), 'container': None})
+            self._save(leases)
+        return allocated
+
+    def update(self, work_dir: Path, pid: t.Optional[int] = None, container: t.Optional[str] = None):
+        """Hand the leases of a work dir over to the process or container that now holds the ports."""
+        with self.lock:
+            leases = self._load()
+            for lease in leases:
+                if lease['work_dir'] == str(work_dir):
+                    lease['pid'] = pid
+                    lease['container'] = container
+            self._save(leases)
+
+    def transfer(self, work_dir: Path, new_work_dir: Path):
+        """Move the leases of a work dir to another one, the ports stay leased throughout."""
+        with self.lock:
+            leases = self._load()
+            for lease in leases:
+                if lease['work_dir'] == str(work_dir):
+                    lease['work_dir'] = str(new_work_dir)
+            self._save(leases)
+
+    def release(self, work_dir: Path, names: t.Optional[t.Iterable[str]] = None):
+        with self.lock:
+            leases = [lease for lease in self._load() if not (
+                    lease['work_dir'] == str(work_dir) and (names is None or lease['name'] in names))]
+            self._save(leases)
+
+    def _load(self) -> t.List[t.Dict[str, t.Any]]:
+        if not self.path.exists():
+            return []
+        with open(self.path) as f:
+            return yaml.safe_load(f) or []
+
+    def _save(self, leases: t.List[t.Dict[str, t.Any]]):
+        atomic_write(self.path, yaml.safe_dump(leases))
+
+    def _reclaim(self, leases: t.List[t.Dict[str, t.Any]]) -> t.List[t.Dict[str, t.Any]]:
+        alive = []
+        by_container = []
+        for lease in leases:
+            if lease['pid'] is not None and pid_exists(lease['pid']):
+                alive.append(lease)
+            elif lease['container'] is not None:
+                by_container.append(lease)
+        if not by_container:
+            return alive
+
+        from docker.errors import DockerException
+        from setupservers.docker_client import container_statuses
+        try:
+            # one list call for all the containers
+            existing = container_statuses({lease['container'] for lease in by_container})
+        except DockerException:
+            # can't tell, keep the leases
+            return alive + by_container
+        return alive + [lease for lease in by_container if lease['container'] in existing]
@@ -0,0 +1,41 @@
+import logging
+import logging.handlers
+import typing as t
+from collections import deque
+from pathlib import Path
+
+
+class OutputLog(object):
+    """
+    Writes the output lines of a process to a size rotated log file as they are produced. Only the last tail_lines
+    are kept in memory, for reporting a failure, so the memory used does not grow with the output. on_line is called
+    with each line, e.g. to parse progress from it.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = 10 * 1024 * 1024, backup_count: int = 3, tail_lines: int = 200,
+                 on_line: t.Optional[t.Callable[[str], None]] = None):
+        self.path: Path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.on_line = on_line
+        self.tail: t.Deque[str] = deque(maxlen=tail_lines)
+        self.lines = 0
+        self._handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                                             encoding='utf-8')
+        self._handler.setFormatter(logging.Formatter('%(message)s'))
+
+    def pump(self, stream: t.BinaryIO, chunk_size: int = 64 * 1024):
+        """Read stream until it ends. Lines longer than chunk_size are split."""
+        try:
+            for raw in iter(lambda: stream.readline(chunk_size), b''):
+                line = raw.decode('utf-8', errors='replace').rstrip('\r\n')
+                self.lines += 1
+                self.tail.append(line)
+                self._handler.handle(logging.makeLogRecord({'msg': line, 'args': None}))
+                if self.on_line is not None:
+                    self.on_line(line)
+        finally:
+            self._handler.close()
+
+    def tail_text(self, lines: t.Optional[int] = None) -> str:
+        tail = list(self.tail)
+        return '\n'.join(tail[-lines:] if lines else tail)
@@ -0,0 +1,96 @@
+import typing as t
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import yaml
+from filelock import FileLock
+
+from setupservers.util import atomic_write, cache_home
+
+INDEX_FIELDS = ['type', 'status', 'port', 'pid', 'container', 'dbs_work_dir', 'dbs_database']
+
+
+class StateIndex(object):
+    """
+    A machine wide, file locked index of work dir states. Each work dir has one entry with its server type, status,
+    port, pid, container id and linked database work dir, so finding the work dir that owns a port, a process or a
+    container, or the FHIR servers using a database, reads one file instead of every state file.
+    """
+
+    def __init__(self, path: t.Optional[Path] = None):
+        self.path: Path = path or cache_home() / 'states.yaml'
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock: FileLock = FileLock(str(self.path) + '.lock')
+
+    def update(self, work_dir: Path, entry: t.Dict[str, t.Any]):
+        with self.lock:
+            entries = self._load()
+            entries[str(work_dir)] = entry
+            self._save(entries)
+
+    def replace(self, root: Path, entries: t.Dict[Path, t.Dict[str, t.Any]]):
+        """Set the entries of all work dirs under root, dropping the ones not in entries."""
+        with self.lock:
+            indexed = {work_dir: entry for work_dir, entry in self._load().items()
+                       if not _is_relative_to(Path(work_dir), root)}
+            indexed.update({str(work_dir): entry for work_dir, entry in entries.items()})
+            self._save(indexed)
+
+    def remove(self, work_dir: Path):
+        with self.lock:
+            entries = self._load()
+            if entries.pop(str(work_dir), None) is not None:
+                self._save(entries)
+
+    def entries(self) -> t.Dict[Path, t.Dict[str, t.Any]]:
+        with self.lock:
+            return {Path(work_dir): entry for work_dir, entry in self._load().items()}
+
+    def find(self, **criteria) -> t.Dict[Path, t.Dict[str, t.Any]]:
+        """The entries matching all criteria, e.g. find(port=5433) or find(type='fhir', dbs_work_dir=path)."""
+        criteria = {name: _normalize(name, value) for name, value in criteria.items()}
+        return {work_dir: entry for work_dir, entry in self.entries().items()
+                if all(entry.get(name) == value for name, value in criteria.items())}
+
+    def _load(self) -> t.Dict[str, t.Dict[str, t.Any]]:
+        if not self.path.exists():
+            return {}
+        with open(self.path) as f:
+            return yaml.safe_load(f) or {}
+
+    def _save(self, entries: t.Dict[str, t.Dict[str, t.Any]]):
+        atomic_write(self.path, yaml.safe_dump(entries))
+
+
+def index_entry(state) -> t.Dict[str, t.Any]:
+    """The index entry of any action state, typed or loaded as a plain ActionState."""
+    entry: t.Dict[str, t.Any] = dict.fromkeys(INDEX_FIELDS)
+    if hasattr(state, 'container_uuid') or hasattr(state, 'dbs_type'):
+        entry['type'] = getattr(state, 'dbs_type', None) or 'postgres'
+        entry['status'] = getattr(state, 'dbs_status', None)
+        entry['port'] = getattr(state, 'dbs_port', None)
+        entry['container'] = getattr(state, 'container_uuid', None)
+    elif hasattr(state, 'fhir_url'):
+        entry['type'] = 'fhir'
+        entry['status'] = state.status
+        entry['pid'] = state.pid
+        entry['port'] = urlsplit(state.fhir_url).port if state.fhir_url else None
+        entry['dbs_work_dir'] = getattr(state, 'dbs_work_dir', None)
+        entry['dbs_database'] = getattr(state, 'dbs_database', None)
+    return {name: _normalize(name, value) for name, value in entry.items()}
+
+
+def _normalize(name: str, value):
+    if value is None:
+        return None
+    if name in ('port', 'pid'):
+        return int(value)
+    return str(value)
+
+
+def _is_relative_to(path: Path, root: Path) -> bool:
+    try:
+        path.relative_to(root)
+        return True
+    except ValueError:
+        return False
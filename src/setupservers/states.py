@@ -1,18 +1,71 @@
 import pathlib
 import typing as t
+from contextlib import contextmanager
 
+import yaml
 from clickactions import ActionState
 
+from setupservers.state_index import StateIndex, index_entry
+from setupservers.util import atomic_write
+
 
 class DBUser:
-    pass
+    def __init__(self, name: str, password: str):
+        self.name: str = name
+        self.password: str = password
 
 
 class DBDatabase:
-    pass
+    def __init__(self, name: str, owner: str):
+        self.name: str = name
+        # the name of the DBUser owning the database, clients connect as that user
+        self.owner: str = owner
+
+
+class IndexedState(ActionState):
+    """
+    Saves made inside batch() are buffered and written once when the outermost batch ends. The state file is
+    replaced atomically and the work dir's StateIndex entry is updated when it changed.
+    """
+    TRANSIENT = ('_batch_depth', '_batch_dirty', '_indexed')
+
+    def __init__(self, path: pathlib.Path):
+        super(IndexedState, self).__init__(path)
+        self._batch_depth: int = 0
+        self._batch_dirty: bool = False
+        self._indexed: t.Optional[t.Dict[str, t.Any]] = None
+
+    def save(self):
+        if self._batch_depth:
+            self._batch_dirty = True
+        else:
+            self.flush()
+
+    @contextmanager
+    def batch(self):
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            # also written when the batch fails, the state has to match what was done before the error
+            self._batch_depth -= 1
+            if not self._batch_depth and self._batch_dirty:
+                self.flush()
+
+    def flush(self):
+        """Write now, also inside a batch."""
+        self._batch_dirty = False
+        self.path.mkdir(parents=True, exist_ok=True)
+        persisted = {name: value for name, value in self.__dict__.items() if name not in IndexedState.TRANSIENT}
+        atomic_write(self.path / ActionState.ACTION_STATE_FILE, yaml.dump(persisted))
+
+        entry = index_entry(self)
+        if entry != self._indexed:
+            StateIndex().update(self.path, entry)
+            self._indexed = entry
 
 
-class DBServerState(ActionState):
+class DBServerState(IndexedState):
     def __init__(self, path: pathlib.Path):
         super(DBServerState, self).__init__(path)
 
@@ -30,6 +83,15 @@ class DBServerState(ActionState):
             self.dbs_port_preferred: t.Optional[str] = None
         if not hasattr(self, 'dbs_status'):
             self.dbs_status: t.Optional[str] = None
+        if not hasattr(self, 'dbs_ready_seconds'):
+            self.dbs_ready_seconds: t.Optional[float] = None
+        # a connection pooler in front of the server, clients should connect to it when it is set
+        if not hasattr(self, 'pooler_host'):
+            self.pooler_host: t.Optional[str] = None
+        if not hasattr(self, 'pooler_port'):
+            self.pooler_port: t.Optional[int] = None
+        if not hasattr(self, 'pooler_mode'):
+            self.pooler_mode: t.Optional[str] = None
 
         if not hasattr(self, 'users'):
             self.users: t.Dict[str, DBUser] = {}
@@ -41,9 +103,13 @@ class DBServerState(ActionState):
         self.dbs_host = None
         self.dbs_port = None
         self.dbs_port_preferred = None
+        self.dbs_ready_seconds = None
+        self.pooler_host = None
+        self.pooler_port = None
+        self.pooler_mode = None
 
 
-class FhirServerState(ActionState):
+class FhirServerState(IndexedState):
     def __init__(self, path: pathlib.Path):
         super(FhirServerState, self).__init__(path)
 
@@ -55,4 +121,14 @@ class FhirServerState(ActionState):
             self.pid: t.Optional[int] = None
         if not hasattr(self, 'status'):
             self.status: t.Optional[str] = None
+        if not hasattr(self, 'fhir_ready_seconds'):
+            self.fhir_ready_seconds: t.Optional[float] = None
+        if not hasattr(self, 'fhir_started_seconds'):
+            # the startup time the server logged
+            self.fhir_started_seconds: t.Optional[float] = None
+        if not hasattr(self, 'fhir_errors'):
+            self.fhir_errors: t.List[str] = []
+        if not hasattr(self, 'ingest_checkpoints'):
+            # file path: {'resources': done, 'size': ..., 'mtime': ...}
+            self.ingest_checkpoints: t.Dict[str, t.Dict[str, t.Any]] = {}
 
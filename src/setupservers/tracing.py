@@ -0,0 +1,143 @@
+import functools
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import typing as t
+from contextlib import contextmanager
+from pathlib import Path
+
+TRACE_FILE = Path('trace.jsonl')
+# trace.jsonl is moved to trace.jsonl.1, replacing the one before, when it grows past this
+TRACE_MAX_BYTES = 10 * 1024 * 1024
+PROFILE_KEY = 'setupservers.profile'
+CHROME_TRACE_KEY = 'setupservers.chrome_trace'
+
+_local = threading.local()
+_lock = threading.Lock()
+_ids = itertools.count(1)
+
+# every span finished in this process, in the order they finished
+completed_spans: t.List[t.Dict[str, t.Any]] = []
+
+
+@contextmanager
+def span(name: str, work_dir: t.Optional[Path] = None, **attrs):
+    """
+    Time a block as a span nested in the current thread's open span. Wall time, the thread's CPU time and the outcome
+    are appended to <work_dir>/trace.jsonl when the block ends. Spans without a work dir use their parent's.
+    """
+    stack: t.List[t.Dict[str, t.Any]] = _stack()
+    parent = stack[-1] if stack else None
+    if work_dir is None and parent is not None:
+        work_dir = parent['work_dir']
+    record = {
+        'id': next(_ids),
+        'parent': parent['id'] if parent is not None else None,
+        'name': name,
+        'work_dir': str(work_dir) if work_dir is not None else None,
+        'pid': os.getpid(),
+        'thread': threading.get_ident(),
+        'start': time.time(),
+        'attrs': attrs,
+    }
+    stack.append(record)
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield record
+        record['outcome'] = 'ok'
+    except BaseException as e:
+        record['outcome'] = f'error: {type(e).__name__}'
+        raise
+    finally:
+        record['wall_seconds'] = time.perf_counter() - wall_start
+        record['cpu_seconds'] = time.thread_time() - cpu_start
+        stack.pop()
+        _finish(record)
+
+
+@contextmanager
+def adopt_span(parent: t.Dict[str, t.Any]):
+    """Nest the spans of this thread's block in parent, a span that is open on another thread."""
+    stack = _stack()
+    stack.append(parent)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def traced(name: str):
+    """Decorator tracing each call as a span. Calls of Action methods are traced into the action's work dir."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            state = getattr(args[0], 'state', None) if args else None
+            with span(name, work_dir=getattr(state, 'path', None)):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def log_profile(logger: logging.Logger, spans: t.Optional[t.List[t.Dict[str, t.Any]]] = None):
+    """Totals per span name, slowest first."""
+    spans = completed_spans if spans is None else spans
+    totals: t.Dict[str, t.List[float]] = {}
+    for record in spans:
+        total = totals.setdefault(record['name'], [0, 0.0, 0.0])
+        total[0] += 1
+        total[1] += record['wall_seconds']
+        total[2] += record['cpu_seconds']
+    if not totals:
+        return
+    width = max(len(name) for name in totals)
+    logger.info(f"{'span'.ljust(width)}  count     wall      cpu")
+    for name, (count, wall, cpu) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        logger.info(f"{name.ljust(width)}  {int(count):5d}  {wall:7.2f}s  {cpu:7.2f}s")
+
+
+def export_chrome_trace(out_path: Path, spans: t.Optional[t.List[t.Dict[str, t.Any]]] = None):
+    """Write spans in the Chrome trace event format (chrome://tracing, Perfetto)."""
+    spans = completed_spans if spans is None else spans
+    events = [{
+        'name': record['name'],
+        'ph': 'X',
+        'ts': record['start'] * 1e6,
+        'dur': record['wall_seconds'] * 1e6,
+        'pid': record['pid'],
+        'tid': record['thread'],
+        'args': dict(record['attrs'], outcome=record['outcome'], cpu_seconds=record['cpu_seconds'],
+                     work_dir=record['work_dir']),
+    } for record in spans]
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(out_path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def _stack() -> t.List[t.Dict[str, t.Any]]:
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _finish(record: t.Dict[str, t.Any]):
+    with _lock:
+        completed_spans.append(record)
+        if record['work_dir'] is None:
+            return
+        trace_path = Path(record['work_dir']) / TRACE_FILE
+        try:
+            trace_path.parent.mkdir(parents=True, exist_ok=True)
+            if trace_path.exists() and trace_path.stat().st_size > TRACE_MAX_BYTES:
+                os.replace(trace_path, trace_path.with_name(f'{TRACE_FILE.name}.1'))
+            with open(trace_path, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+        except OSError:
+            # tracing never fails the traced work
+            pass
@@ -1,11 +1,17 @@
 import errno
+import hashlib
 import os
 import pathlib
 import re
+import shutil
 import socket
+import struct
+import threading
+import time
+import typing as t
 from contextlib import closing
 
-import requests
+from setupservers.tracing import traced
 
 
 def is_port_available(host, port):
@@ -26,6 +32,14 @@ def find_free_port(host, port: int):
         return s.getsockname()[1]
 
 
+def host_memory_bytes() -> t.Optional[int]:
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        # not available on Windows
+        return None
+
+
 def docker_container_name(module_name: str, work_dir: pathlib.Path):
     split = module_name.split('.')
     name = split[0]
@@ -41,23 +55,224 @@ def docker_container_name(module_name: str, work_dir: pathlib.Path):
     return name
 
 
-def download_file(url, to_path: pathlib.Path):
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        with open(to_path, 'wb') as f:
-            f.write(response.raw.read())
-    else:
-        raise Exception(str(response))
+def cache_home() -> pathlib.Path:
+    """The user level cache shared by all work dirs. Can be moved with the SETUP_SERVERS_CACHE environment variable."""
+    if 'SETUP_SERVERS_CACHE' in os.environ:
+        return pathlib.Path(os.environ['SETUP_SERVERS_CACHE'])
+    return pathlib.Path(os.environ.get('XDG_CACHE_HOME', pathlib.Path.home() / '.cache')) / 'setup-servers'
+
+
+def atomic_write(path: pathlib.Path, text: str):
+    """Replace path with text by renaming a temporary file over it, readers never see a partly written file."""
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}-{threading.get_ident()}.tmp')
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def link_or_copy(src: pathlib.Path, dst: pathlib.Path):
+    """Hardlink src to dst, or copy it when linking is not possible (e.g. across file systems)."""
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def clone_file(src, dst, *, follow_symlinks=True):
+    """Copy a file as a copy-on-write reflink where the file system supports it (btrfs, xfs, ...), otherwise a plain
+    copy. Usable as a shutil.copytree copy_function.
+    """
+    try:
+        import fcntl
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            # FICLONE
+            fcntl.ioctl(dst_file.fileno(), 0x40049409, src_file.fileno())
+        shutil.copystat(src, dst, follow_symlinks=follow_symlinks)
+        return dst
+    except (ImportError, OSError):
+        return shutil.copy2(src, dst, follow_symlinks=follow_symlinks)
 
 
-def unpack_targz(file: pathlib.Path, to_dir_path: pathlib.Path):
+def tree_sha256(path: pathlib.Path, chunk_size: int = 1024 * 1024) -> str:
+    """A hash over the relative paths and contents of all files under path."""
+    sha256 = hashlib.sha256()
+    for dir_path, dir_names, file_names in os.walk(path):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            file_path = pathlib.Path(dir_path) / file_name
+            sha256.update(str(file_path.relative_to(path)).encode('utf-8') + b'\0')
+            if file_path.is_symlink():
+                sha256.update(os.readlink(file_path).encode('utf-8'))
+                continue
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+@traced('download')
+def download_file(url, to_path: pathlib.Path, sha512_url: t.Optional[str] = None, chunk_size: int = 1024 * 1024):
+    """Stream url to to_path in chunks. An interrupted download is left as a .part file next to to_path and is resumed
+    with an HTTP Range request on the next call. When sha512_url is given (e.g. Apache's .sha512 files) the download is
+    verified before it is moved into place.
+    """
+    import requests
+
+    part_path = to_path.with_name(to_path.name + '.part')
+    headers = {}
+    if part_path.exists() and part_path.stat().st_size > 0:
+        headers['Range'] = f'bytes={part_path.stat().st_size}-'
+
+    with requests.get(url, stream=True, headers=headers, timeout=60) as response:
+        if response.status_code == 206:
+            mode = 'ab'
+        elif response.status_code == 200:
+            mode = 'wb'
+        elif response.status_code == 416:
+            # the part file is already complete
+            mode = None
+        else:
+            raise Exception(str(response))
+        if mode is not None:
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+
+    if sha512_url is not None:
+        response = requests.get(sha512_url, timeout=60)
+        if response.status_code != 200:
+            raise Exception(str(response))
+        expected = response.text.split()[0].lower()
+        actual = file_sha512(part_path)
+        if actual != expected:
+            part_path.unlink()
+            raise Exception(f'SHA-512 mismatch for {url}: expected {expected} but got {actual}')
+
+    part_path.replace(to_path)
+
+
+def file_sha512(file: pathlib.Path, chunk_size: int = 1024 * 1024) -> str:
+    sha512 = hashlib.sha512()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha512.update(chunk)
+    return sha512.hexdigest()
+
+
+@traced('unpack')
+def unpack_targz(file: pathlib.Path, to_dir_path: pathlib.Path) -> bool:
+    """Extract a tar or tar.gz file member by member as it is read. A manifest of the extracted members is written next
+    to them and a later call with the same archive is skipped while that manifest is intact. Returns True if the archive
+    was extracted.
+    """
     import tarfile
     if file.name.endswith("tar.gz"):
-        with tarfile.open(file, "r:gz") as tar:
-            tar.extractall(path=to_dir_path)
+        mode = "r|gz"
     elif file.name.endswith("tar"):
-        with tarfile.open(file, "r:") as tar:
-            tar.extractall(path=to_dir_path)
+        mode = "r|"
+    else:
+        return False
+
+    stat = file.stat()
+    archive_id = f'{file.name} {stat.st_size} {int(stat.st_mtime)}'
+    manifest_path = to_dir_path / f'.{file.name}.manifest'
+    if manifest_path.exists():
+        lines = manifest_path.read_text().splitlines()
+        if lines and lines[0] == archive_id and all((to_dir_path / name).exists() for name in lines[1:]):
+            return False
+
+    to_dir_path.mkdir(parents=True, exist_ok=True)
+    target = to_dir_path.resolve()
+    names = []
+    with tarfile.open(file, mode) as tar:
+        for member in tar:
+            _check_tar_member(member, target)
+            if hasattr(tarfile, 'data_filter'):
+                tar.extract(member, path=target, filter='fully_trusted')
+            else:
+                tar.extract(member, path=target)
+            names.append(member.name)
+    manifest_path.write_text('\n'.join([archive_id] + names))
+    return True
+
+
+def _check_tar_member(member, target: pathlib.Path):
+    if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+        raise Exception(f'Refusing to extract special file: {member.name}')
+    member_path = (target / member.name).resolve()
+    if member_path != target and target not in member_path.parents:
+        raise Exception(f'Refusing to extract outside of {target}: {member.name}')
+    if member.issym() or member.islnk():
+        link_base = member_path.parent if member.issym() else target
+        link_path = (link_base / member.linkname).resolve()
+        if link_path != target and target not in link_path.parents:
+            raise Exception(f'Refusing to extract link pointing outside of {target}: {member.name}')
+
+
+def wait_until(check: t.Callable[[], bool], timeout: float, interval: float = 0.25) -> float:
+    """Call check every interval seconds until it returns True. Returns the elapsed seconds."""
+    start = time.monotonic()
+    while not check():
+        if time.monotonic() - start >= timeout:
+            raise TimeoutError(f'Not ready after {timeout} seconds.')
+        time.sleep(interval)
+    return time.monotonic() - start
+
+
+def is_postgres_ready(host, port, user='postgres', database='postgres'):
+    """Check whether PostgreSQL accepts connections by sending a protocol 3.0 startup message.
+    An authentication request means the server is up, a "starting up" error (57P03) means it is not yet.
+    """
+    startup_params = f'user\0{user}\0database\0{database}\0\0'.encode('utf-8')
+    try:
+        with closing(socket.create_connection((host, int(port)), timeout=2)) as sock:
+            sock.sendall(struct.pack('!ii', 8 + len(startup_params), 196608) + startup_params)
+            reply = sock.recv(4096)
+    except OSError:
+        return False
+    if reply[:1] == b'R':
+        return True
+    if reply[:1] == b'E':
+        return b'C57P03\0' not in reply
+    return False
+
+
+def is_http_ready(url):
+    import requests
+
+    try:
+        return requests.get(url, timeout=2).status_code == 200
+    except requests.RequestException:
+        return False
+
+
+def process_peak_rss(pid) -> t.Optional[int]:
+    """Peak resident set size of a process in bytes (VmHWM). Linux only, None elsewhere."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reap_child(pid) -> bool:
+    """Collect the exit status of pid when it is an exited child of this process. Until then it stays in the process
+    table as a zombie and pid_exists is True. UNIX only."""
+    try:
+        reaped, _ = os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        # not our child, or already collected
+        return False
+    return reaped == pid
 
 
 def pid_exists(pid):
@@ -0,0 +1,119 @@
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from setupservers.cache import cached_download
+from setupservers.util import download_file
+
+CONTENT = bytes(range(256)) * 1000
+
+
+class StubFileHandler(BaseHTTPRequestHandler):
+    """Serves the files of server.files, with Range requests unless server.ranges is off."""
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        range_header = self.headers.get('Range')
+        if range_header and self.server.ranges:
+            start = int(range_header[len('bytes='):].rstrip('-'))
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(content)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(content) - 1}/{len(content)}')
+            content = content[start:]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def file_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubFileHandler)
+    server.files = {
+        '/tool.tar.gz': CONTENT,
+        '/tool.tar.gz.sha512': f'{hashlib.sha512(CONTENT).hexdigest()}  tool.tar.gz\n'.encode('utf-8'),
+        '/wrong.sha512': f'{hashlib.sha512(b"other").hexdigest()}  tool.tar.gz\n'.encode('utf-8'),
+    }
+    server.ranges = True
+    server.requests = []
+    server.url = f'http://127.0.0.1:{server.server_port}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_verified(file_server, tmp_path):
+    to_path = tmp_path / 'tool.tar.gz'
+    download_file(f'{file_server.url}/tool.tar.gz', to_path, f'{file_server.url}/tool.tar.gz.sha512',
+                  chunk_size=1000)
+    assert to_path.read_bytes() == CONTENT
+    assert not (tmp_path / 'tool.tar.gz.part').exists()
+    assert file_server.requests[0] == ('/tool.tar.gz', None)
+
+
+def test_part_file_is_resumed_with_range(file_server, tmp_path):
+    to_path = tmp_path / 'tool.tar.gz'
+    (tmp_path / 'tool.tar.gz.part').write_bytes(CONTENT[:1234])
+    download_file(f'{file_server.url}/tool.tar.gz', to_path, f'{file_server.url}/tool.tar.gz.sha512')
+    assert file_server.requests[0] == ('/tool.tar.gz', 'bytes=1234-')
+    assert to_path.read_bytes() == CONTENT
+
+
+def test_complete_part_file_answered_with_416(file_server, tmp_path):
+    to_path = tmp_path / 'tool.tar.gz'
+    (tmp_path / 'tool.tar.gz.part').write_bytes(CONTENT)
+    download_file(f'{file_server.url}/tool.tar.gz', to_path, f'{file_server.url}/tool.tar.gz.sha512')
+    assert file_server.requests[0] == ('/tool.tar.gz', f'bytes={len(CONTENT)}-')
+    assert to_path.read_bytes() == CONTENT
+
+
+def test_server_without_ranges_restarts(file_server, tmp_path):
+    file_server.ranges = False
+    to_path = tmp_path / 'tool.tar.gz'
+    (tmp_path / 'tool.tar.gz.part').write_bytes(b'stale bytes')
+    download_file(f'{file_server.url}/tool.tar.gz', to_path, f'{file_server.url}/tool.tar.gz.sha512')
+    assert to_path.read_bytes() == CONTENT
+
+
+def test_sha512_mismatch(file_server, tmp_path):
+    to_path = tmp_path / 'tool.tar.gz'
+    with pytest.raises(Exception, match='SHA-512 mismatch'):
+        download_file(f'{file_server.url}/tool.tar.gz', to_path, f'{file_server.url}/wrong.sha512')
+    assert not to_path.exists()
+    # a corrupt part file is not resumed by the next call
+    assert not (tmp_path / 'tool.tar.gz.part').exists()
+
+
+def test_missing_file(file_server, tmp_path):
+    with pytest.raises(Exception, match='404'):
+        download_file(f'{file_server.url}/missing.tar.gz', tmp_path / 'missing.tar.gz')
+    assert not (tmp_path / 'missing.tar.gz').exists()
+
+
+def test_cached_download_once(file_server, tmp_path, monkeypatch):
+    monkeypatch.setenv('SETUP_SERVERS_CACHE', str(tmp_path / 'cache'))
+    first = cached_download(f'{file_server.url}/tool.tar.gz', f'{file_server.url}/tool.tar.gz.sha512')
+    requests = len(file_server.requests)
+    second = cached_download(f'{file_server.url}/tool.tar.gz', f'{file_server.url}/tool.tar.gz.sha512')
+    assert first == second
+    assert first.name == 'tool.tar.gz' and first.read_bytes() == CONTENT
+    assert len(file_server.requests) == requests
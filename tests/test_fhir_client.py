@@ -0,0 +1,160 @@
+import asyncio
+import typing as t
+from urllib.parse import urlsplit
+
+import pytest
+
+from setupservers.fhir_client import FhirConnection
+
+
+class StubServer(object):
+    """Answers each request read from a connection with the next canned raw response."""
+
+    def __init__(self, responses: t.List[bytes]):
+        self.responses = list(responses)
+        self.requests: t.List[t.Tuple[str, t.Dict[str, str], bytes]] = []
+        self.connections = 0
+        self.server: t.Optional[asyncio.AbstractServer] = None
+        self.url: t.Optional[str] = None
+
+    async def __aenter__(self) -> 'StubServer':
+        self.server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        self.url = f'http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/fhir'
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            while self.responses:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests.append((request_line.decode('latin-1').strip(), headers, body))
+                response = self.responses.pop(0)
+                writer.write(response)
+                await writer.drain()
+                if b'Connection: close' in response or b'Content-Length' not in response and \
+                        b'chunked' not in response:
+                    return
+        finally:
+            writer.close()
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_content_length_and_keep_alive():
+    async def scenario():
+        async with StubServer([b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\nX-Test: a:b\r\n\r\n{}',
+                               b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n']) as server:
+            connection = FhirConnection(urlsplit(server.url), timeout=5)
+            first = await connection.request('GET', 'Patient/1')
+            second = await connection.request('GET', 'Patient/2')
+            connection.close()
+            return server, first, second
+
+    server, first, second = run(scenario())
+    assert first == (200, {'content-length': '2', 'x-test': 'a:b'}, b'{}')
+    assert second[0] == 404 and second[2] == b''
+    # both requests went over one connection
+    assert server.connections == 1
+    assert [request[0] for request in server.requests] == ['GET /fhir/Patient/1 HTTP/1.1',
+                                                           'GET /fhir/Patient/2 HTTP/1.1']
+    assert server.requests[0][1]['host'] == urlsplit(server.url).netloc
+
+
+def test_chunked_body_with_extensions_and_trailers():
+    response = (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                b'5;name=value\r\nhello\r\n6\r\n world\r\n0\r\nX-Trailer: yes\r\n\r\n')
+
+    async def scenario():
+        async with StubServer([response, b'HTTP/1.1 204 No Content\r\n\r\n']) as server:
+            connection = FhirConnection(urlsplit(server.url), timeout=5)
+            chunked = await connection.request('GET', 'Patient')
+            # the trailers were consumed, the connection is usable for the next response
+            empty = await connection.request('DELETE', 'Patient/1')
+            connection.close()
+            return server, chunked, empty
+
+    server, chunked, empty = run(scenario())
+    assert chunked[0] == 200 and chunked[2] == b'hello world'
+    assert empty == (204, {}, b'')
+    assert server.connections == 1
+
+
+def test_post_body_and_close_delimited_response():
+    async def scenario():
+        async with StubServer([b'HTTP/1.1 201 Created\r\nLocation: x\r\n\r\n{"id": "7"}',
+                               b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n']) as server:
+            connection = FhirConnection(urlsplit(server.url), timeout=5)
+            created = await connection.request('POST', 'Patient', b'{"resourceType": "Patient"}')
+            assert connection.writer is None
+            # a new connection for the request after the server closed the first one
+            after = await connection.request('GET', '')
+            connection.close()
+            return server, created, after
+
+    server, created, after = run(scenario())
+    assert created[0] == 201 and created[2] == b'{"id": "7"}'
+    method, headers, body = server.requests[0]
+    assert method == 'POST /fhir/Patient HTTP/1.1'
+    assert headers['content-type'] == 'application/fhir+json'
+    assert body == b'{"resourceType": "Patient"}'
+    assert after[0] == 200
+    assert server.requests[1][0] == 'GET /fhir HTTP/1.1'
+    assert server.connections == 2
+
+
+def test_connection_close_header_closes():
+    async def scenario():
+        async with StubServer([b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n']) as server:
+            connection = FhirConnection(urlsplit(server.url), timeout=5)
+            response = await connection.request('GET', 'metadata')
+            return connection, response
+
+    connection, response = run(scenario())
+    assert response[0] == 200
+    assert connection.writer is None
+
+
+def test_closed_connection_raises_and_resets():
+    async def scenario():
+        async with StubServer([]) as server:
+            connection = FhirConnection(urlsplit(server.url), timeout=5)
+            with pytest.raises(ConnectionResetError):
+                await connection.request('GET', 'metadata')
+            return connection
+
+    assert run(scenario()).writer is None
+
+
+def test_timeout():
+    async def scenario():
+        async def silent(reader, writer):
+            await asyncio.sleep(5)
+            writer.close()
+
+        server = await asyncio.start_server(silent, '127.0.0.1', 0)
+        url = f'http://127.0.0.1:{server.sockets[0].getsockname()[1]}'
+        connection = FhirConnection(urlsplit(url), timeout=0.2)
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await connection.request('GET', 'metadata')
+        finally:
+            server.close()
+        return connection
+
+    assert run(scenario()).writer is None
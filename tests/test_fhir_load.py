@@ -0,0 +1,118 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+import pytest
+
+from setupservers.command.fhir_load import FhirLoad, parse_mix, _created_id, _latency_summary
+
+
+class StubFhirHandler(BaseHTTPRequestHandler):
+    """Patients in memory: create, read by id and a search returning an empty Bundle. Keeps connections alive."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.created += 1
+            resource_id = str(self.server.created)
+        self._reply(201, {'resourceType': 'Patient', 'id': resource_id},
+                    {'Location': f'http://{self.headers["Host"]}/fhir/Patient/{resource_id}/_history/1'})
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        path, _, query = self.path.partition('?')
+        if path == '/fhir/Patient' and query:
+            self._reply(200, {'resourceType': 'Bundle', 'type': 'searchset', 'total': 0})
+        elif path.startswith('/fhir/Patient/') and int(path.rsplit('/', 1)[1]) <= self.server.created:
+            self._reply(200, {'resourceType': 'Patient', 'id': path.rsplit('/', 1)[1]})
+        else:
+            self._reply(404, {'resourceType': 'OperationOutcome'})
+
+    def _reply(self, status, resource, headers=None):
+        body = json.dumps(resource).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/fhir+json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fhir_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubFhirHandler)
+    server.lock = threading.Lock()
+    server.created = 0
+    server.connections = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_load_against_stub(fhir_server):
+    url = f'http://127.0.0.1:{fhir_server.server_port}/fhir'
+    load = FhirLoad(url, parse_mix('read=70,search=20,create=10'), {'resourceType': 'Patient'}, concurrency=4,
+                    duration=30, max_requests=200, seed_resources=5, random_seed=1)
+    report = asyncio.run(load.run())
+
+    assert report['requests'] == 200
+    assert report['errors'] == 0
+    assert report['status_codes'] == {'200': sum(report['operations'][name]['requests']
+                                                 for name in ('read', 'search')),
+                                      '201': report['operations']['create']['requests']}
+    assert set(report['operations']) == {'create', 'read', 'search'}
+    assert report['p50_ms'] <= report['p95_ms'] <= report['p99_ms'] <= report['max_ms']
+    # the seeded resources and the ones created during the run are read back
+    assert len(load.ids) == fhir_server.created
+    # one keep-alive connection per worker, reads and searches don't reconnect
+    assert len(fhir_server.connections) <= 4
+
+
+def test_errors_are_counted(fhir_server):
+    url = f'http://127.0.0.1:{fhir_server.server_port}/fhir'
+    load = FhirLoad(url, {'search': 1}, {'resourceType': 'Observation'}, search_query='code=x', concurrency=2,
+                    max_requests=10, seed_resources=0)
+    report = asyncio.run(load.run())
+    assert report['errors'] == 10
+    assert report['status_codes'] == {'404': 10}
+    assert report['p50_ms'] is None
+
+
+def test_unreachable_server():
+    load = FhirLoad('http://127.0.0.1:1/fhir', {'create': 1}, {'resourceType': 'Patient'}, concurrency=1,
+                    max_requests=3, seed_resources=0, timeout=2)
+    report = asyncio.run(load.run())
+    assert report['errors'] == 3
+    assert report['status_codes'] == {'None': 3}
+    assert sum(report['error_messages'].values()) == 3
+
+
+def test_parse_mix():
+    assert parse_mix('read=2, create=1') == {'read': 2.0, 'create': 1.0}
+    with pytest.raises(click.BadParameter):
+        parse_mix('delete=1')
+    with pytest.raises(click.BadParameter):
+        parse_mix('read=x')
+    with pytest.raises(click.BadParameter):
+        parse_mix('read=0')
+
+
+def test_created_id():
+    assert _created_id({'location': 'http://h/fhir/Patient/12/_history/1'}, b'') == '12'
+    assert _created_id({}, b'{"id": "13"}') == '13'
+    assert _created_id({}, b'not json') is None
+
+
+def test_latency_summary_nearest_rank():
+    latencies = [i / 1000 for i in range(1, 101)]
+    assert _latency_summary(latencies) == pytest.approx({'p50_ms': 50, 'p95_ms': 95, 'p99_ms': 99, 'max_ms': 100})
+    assert _latency_summary([0.004]) == pytest.approx({'p50_ms': 4, 'p95_ms': 4, 'p99_ms': 4, 'max_ms': 4})
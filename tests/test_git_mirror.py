@@ -0,0 +1,89 @@
+import logging
+import shutil
+
+import git
+import pytest
+from git import Repo
+
+from setupservers.git_mirror import GitMirror
+
+LOGGER = logging.getLogger('test_git_mirror')
+
+
+@pytest.fixture
+def upstream(tmp_path, monkeypatch):
+    """A local repository standing in for the HAPI starter on GitHub, with two commits on its branch."""
+    monkeypatch.setenv('SETUP_SERVERS_CACHE', str(tmp_path / 'cache'))
+    for name in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv(f'GIT_{name}_NAME', 'Test')
+        monkeypatch.setenv(f'GIT_{name}_EMAIL', 'test@example.com')
+    repo = Repo.init(tmp_path / 'upstream')
+    for content in ('one', 'two'):
+        (tmp_path / 'upstream' / 'file.txt').write_text(content)
+        repo.index.add(['file.txt'])
+        repo.index.commit(content)
+    yield repo
+    repo.close()
+
+
+def _commits(repo: Repo):
+    return [commit.hexsha for commit in repo.iter_commits()]
+
+
+def test_worktrees_share_one_mirror(upstream, tmp_path, monkeypatch):
+    clones = []
+    clone_from = Repo.clone_from
+    monkeypatch.setattr(Repo, 'clone_from', lambda *args, **kwargs: clones.append(args) or clone_from(*args, **kwargs))
+    mirror = GitMirror(upstream.working_dir, LOGGER)
+    branch = upstream.active_branch.name
+
+    first = mirror.checkout(branch, tmp_path / 'work1')
+    second = mirror.checkout(branch, tmp_path / 'work2')
+
+    assert first == second == upstream.head.commit.hexsha
+    assert len(clones) == 1
+    assert (tmp_path / 'work2' / 'file.txt').read_text() == 'two'
+    with Repo(mirror.path) as bare:
+        assert bare.bare
+        worktrees = bare.git.worktree('list')
+    assert str(tmp_path / 'work1') in worktrees and str(tmp_path / 'work2') in worktrees
+
+
+def test_known_sha_is_not_fetched(upstream, tmp_path, caplog):
+    mirror = GitMirror(upstream.working_dir, LOGGER)
+    older = _commits(upstream)[1]
+    mirror.checkout(upstream.active_branch.name, tmp_path / 'work1')
+    # a fetch would now fail and log a warning
+    shutil.rmtree(upstream.working_dir)
+
+    with caplog.at_level(logging.WARNING, logger=LOGGER.name):
+        assert mirror.checkout(older[:10], tmp_path / 'work2') == older
+    assert not caplog.records
+    assert (tmp_path / 'work2' / 'file.txt').read_text() == 'one'
+
+
+def test_branch_is_fetched(upstream, tmp_path):
+    mirror = GitMirror(upstream.working_dir, LOGGER)
+    branch = upstream.active_branch.name
+    mirror.checkout(branch, tmp_path / 'work')
+
+    (tmp_path / 'upstream' / 'file.txt').write_text('three')
+    upstream.index.add(['file.txt'])
+    newer = upstream.index.commit('three').hexsha
+
+    assert mirror.checkout(branch, tmp_path / 'work') == newer
+    assert (tmp_path / 'work' / 'file.txt').read_text() == 'three'
+
+
+def test_offline_uses_the_mirrored_ref(upstream, tmp_path, caplog):
+    mirror = GitMirror(upstream.working_dir, LOGGER)
+    branch = upstream.active_branch.name
+    sha = mirror.checkout(branch, tmp_path / 'work1')
+    shutil.rmtree(upstream.working_dir)
+
+    with caplog.at_level(logging.WARNING, logger=LOGGER.name):
+        assert mirror.checkout(branch, tmp_path / 'work2') == sha
+    assert any('failed' in record.message for record in caplog.records)
+
+    with pytest.raises(git.GitCommandError):
+        mirror.checkout('no-such-branch', tmp_path / 'work3')
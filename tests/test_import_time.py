@@ -0,0 +1,17 @@
+import json
+import subprocess
+import sys
+
+from setupservers.command.import_bench import HEAVY_MODULES
+
+
+def test_cli_import_loads_no_heavy_modules():
+    """Loading the CLI must not import what only actions need, see import-bench."""
+    code = ('import json, sys; import setupservers.commands; '
+            f'print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]))')
+    completed = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert json.loads(completed.stdout.splitlines()[-1]) == []
+
+
+def test_heavy_modules_listed():
+    assert set(HEAVY_MODULES) >= {'docker', 'git', 'requests', 'pydevd', 'tarfile'}